@@ -0,0 +1,115 @@
+import random
+import time
+
+import torch
+
+from src.programs.encoders import supported_encoder_backends
+
+import argparse
+
+
+def throughput(encoder, sentences: list[str], batch_size: int) -> float:
+    """Sentences per second, after one warm-up batch."""
+    encoder.encode(
+        sentences[:batch_size], batch_size=batch_size, convert_to_tensor=True
+    )
+    start = time.perf_counter()
+    encoder.encode(sentences, batch_size=batch_size, convert_to_tensor=True)
+    return len(sentences) / (time.perf_counter() - start)
+
+
+def benchmark_encoder(
+    model_name: str, backend: str, sentences: list[str], batch_size: int
+):
+    torch.set_grad_enabled(False)
+    reference = supported_encoder_backends["torch"](model_name)
+    candidate = supported_encoder_backends[backend](model_name)
+
+    # parity: cosine between the reference and candidate embedding of every sentence
+    reference_embeddings = reference.encode(
+        sentences,
+        batch_size=batch_size,
+        convert_to_tensor=True,
+        normalize_embeddings=True,
+    )
+    candidate_embeddings = candidate.encode(
+        sentences,
+        batch_size=batch_size,
+        convert_to_tensor=True,
+        normalize_embeddings=True,
+    )
+    cosine = (reference_embeddings * candidate_embeddings).sum(dim=1)
+    drift = 1.0 - cosine
+
+    # retrieval parity: does the candidate find the same nearest sentences as the reference?
+    reference_top = (
+        (reference_embeddings @ reference_embeddings.T).topk(10, dim=1).indices
+    )
+    candidate_top = (
+        (candidate_embeddings @ reference_embeddings.T).topk(10, dim=1).indices
+    )
+    top1_agreement = (reference_top[:, 0] == candidate_top[:, 0]).float().mean()
+    top10_overlap = sum(
+        len(set(r.tolist()) & set(c.tolist())) / 10
+        for r, c in zip(reference_top, candidate_top)
+    ) / len(sentences)
+
+    print(f"Cosine drift vs reference: mean {drift.mean():.6f}, max {drift.max():.6f}")
+    print(f"Top-1 agreement: {top1_agreement:.4f}, top-10 overlap: {top10_overlap:.4f}")
+
+    reference_throughput = throughput(reference, sentences, batch_size)
+    candidate_throughput = throughput(candidate, sentences, batch_size)
+    print(f"Throughput torch: {reference_throughput:.1f} sentences/s")
+    print(
+        f"Throughput {backend}: {candidate_throughput:.1f} sentences/s "
+        f"({candidate_throughput / reference_throughput:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare a query encoder backend to the reference SentenceTransformer: cosine drift and throughput."
+    )
+
+    # Add arguments
+    parser.add_argument(
+        "--retriever_model_name",
+        type=str,
+        default="sentence-transformers/all-mpnet-base-v2",
+        help="Specify the retriever model name (default: sentence-transformers/all-mpnet-base-v2)",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="quantized",
+        choices=[name for name in supported_encoder_backends if name != "torch"],
+        help="Specify the encoder backend to compare (default: quantized)",
+    )
+    parser.add_argument(
+        "--sentences_path",
+        type=str,
+        help="File with one sentence per line, e.g. an ontology file.",
+    )
+    parser.add_argument(
+        "--n_sentences",
+        type=int,
+        default=2000,
+        help="Number of sentences to sample from the file (default: 2000)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Encoder batch size (default: 64)",
+    )
+
+    args = parser.parse_args()
+
+    with open(args.sentences_path, "r") as fp:
+        sentences = [line.strip("\n") for line in fp.readlines()]
+    random.seed(42)
+    sentences = random.sample(sentences, min(args.n_sentences, len(sentences)))
+
+    benchmark_encoder(
+        args.retriever_model_name, args.backend, sentences, args.batch_size
+    )
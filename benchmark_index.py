@@ -0,0 +1,135 @@
+import random
+import time
+
+import torch
+
+from src.programs import IreraConfig, Retriever
+from src.programs.index import supported_indexes, load_index
+
+import argparse
+
+
+def recall_at_k(exact_ids: torch.Tensor, approximate_ids: torch.Tensor) -> float:
+    """Fraction of the exact top K that the approximate top K recovers, averaged over queries."""
+    hits = [
+        len(set(e.tolist()) & set(a.tolist())) / len(e)
+        for e, a in zip(exact_ids, approximate_ids)
+    ]
+    return sum(hits) / len(hits)
+
+
+def benchmark_index(
+    config: IreraConfig, queries: list[str], ks: list[int], sweep: list[int]
+):
+    # the exact retriever holds the model, the embeddings and the reference index
+    exact_config = IreraConfig.from_dict(
+        config.to_dict() | {"retriever_index_name": "exact"}
+    )
+    retriever = Retriever(exact_config)
+    exact_index = retriever.index
+    query_embeddings = retriever.model.encode(
+        queries, convert_to_tensor=True, normalize_embeddings=True
+    )
+
+    start = time.perf_counter()
+    approximate_index = load_index(
+        config, retriever.ontology_embeddings, retriever.ontology.embeddings_filename
+    )
+    print(
+        f"{config.retriever_index_name} index ready in {time.perf_counter() - start:.2f}s"
+    )
+
+    max_k = max(ks)
+    exact_ids = exact_index.search(query_embeddings, max_k)[1]
+
+    # the search-time parameter that trades recall for latency
+    knob = (
+        "retriever_index_ef_search"
+        if config.retriever_index_name == "hnsw"
+        else "retriever_index_nprobe"
+    )
+    for value in sweep:
+        setattr(config, knob, value)
+        approximate_index.configure(config)
+
+        start = time.perf_counter()
+        approximate_ids = approximate_index.search(query_embeddings, max_k)[1]
+        latency = (time.perf_counter() - start) / len(queries)
+
+        recalls = ", ".join(
+            f"recall@{k}: {recall_at_k(exact_ids[:, :k], approximate_ids[:, :k]):.4f}"
+            for k in ks
+        )
+        print(f"{knob}={value}: {latency * 1000:.3f} ms/query, {recalls}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report recall@K and latency of an approximate label index against exact search."
+    )
+
+    # Add arguments
+    parser.add_argument("--ontology_path", type=str, help="Path to the ontology file.")
+    parser.add_argument("--ontology_name", type=str, help="Name of the ontology.")
+    parser.add_argument(
+        "--retriever_model_name",
+        type=str,
+        default="sentence-transformers/all-mpnet-base-v2",
+        help="Specify the retriever model name (default: sentence-transformers/all-mpnet-base-v2)",
+    )
+    parser.add_argument(
+        "--index_name",
+        type=str,
+        default="hnsw",
+        choices=[name for name in supported_indexes if name != "exact"],
+        help="Specify the approximate index to benchmark (default: hnsw)",
+    )
+    parser.add_argument(
+        "--queries_path",
+        type=str,
+        default=None,
+        help="File with one query per line. Defaults to a sample of ontology terms.",
+    )
+    parser.add_argument(
+        "--n_queries",
+        type=int,
+        default=1000,
+        help="Number of ontology terms to sample as queries if no query file is given (default: 1000)",
+    )
+    parser.add_argument(
+        "--ks",
+        type=int,
+        nargs="+",
+        default=[1, 10, 50],
+        help="Values of K to report recall@K for (default: 1 10 50)",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=int,
+        nargs="+",
+        default=[16, 32, 64, 128, 256],
+        help="Values of ef_search (hnsw) or nprobe (ivf) to try (default: 16 32 64 128 256)",
+    )
+
+    args = parser.parse_args()
+
+    config = IreraConfig(
+        infer_signature_name=None,
+        rank_signature_name=None,
+        ontology_path=args.ontology_path,
+        ontology_name=args.ontology_name,
+        retriever_model_name=args.retriever_model_name,
+        retriever_index_name=args.index_name,
+        retriever_index_topk=max(args.ks),
+    )
+
+    if args.queries_path:
+        with open(args.queries_path, "r") as fp:
+            queries = [line.strip("\n") for line in fp.readlines()]
+    else:
+        with open(args.ontology_path, "r") as fp:
+            terms = [line.strip("\n") for line in fp.readlines()]
+        random.seed(42)
+        queries = random.sample(terms, min(args.n_queries, len(terms)))
+
+    benchmark_index(config, queries, args.ks, args.sweep)
@@ -0,0 +1,74 @@
+import os
+
+os.environ["DSP_NOTEBOOK_CACHEDIR"] = os.path.join(".", "local_cache")
+
+import subprocess
+import sys
+import time
+
+import argparse
+
+
+def import_time(module: str) -> float:
+    """Seconds to import `module` in a fresh interpreter."""
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def benchmark_startup(state_path: str, lm_config_path: str, text: str, lazy_load: bool):
+    print(f"import src.programs: {import_time('src.programs'):.2f}s")
+    # the retriever imports torch on first use, so this is paid by the first prediction
+    print(f"import torch: {import_time('torch'):.2f}s")
+
+    start = time.perf_counter()
+    from dspy import Models
+    from src.programs import InferRetrieveRank
+
+    Models(config_path=lm_config_path)
+    imported = time.perf_counter()
+
+    program = InferRetrieveRank.load(state_path, lazy_load=lazy_load)
+    loaded = time.perf_counter()
+
+    program(text)
+    first_prediction = time.perf_counter()
+
+    program(text)
+    second_prediction = time.perf_counter()
+
+    print(f"imports and LM setup: {imported - start:.2f}s")
+    print(f"InferRetrieveRank.load (lazy_load={lazy_load}): {loaded - imported:.2f}s")
+    print(f"first prediction: {first_prediction - loaded:.2f}s")
+    print(f"time-to-first-prediction: {first_prediction - start:.2f}s")
+    print(f"second prediction: {second_prediction - first_prediction:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report import time and time-to-first-prediction of a saved Infer-Retrieve-Rank program."
+    )
+
+    # Add arguments
+    parser.add_argument("--state_path", type=str)
+    parser.add_argument("--lm_config_path", type=str)
+    parser.add_argument(
+        "--text",
+        type=str,
+        default="We are looking for a Python developer who enjoys working in a team and reviewing code.",
+        help="Input text for the predictions",
+    )
+    parser.add_argument(
+        "--lazy_load",
+        action="store_true",
+        help="Defer loading the retriever model, ontology and prior until the first prediction (default: False)",
+    )
+
+    args = parser.parse_args()
+
+    benchmark_startup(args.state_path, args.lm_config_path, args.text, args.lazy_load)
@@ -0,0 +1,168 @@
+import os
+
+os.environ["DSP_NOTEBOOK_CACHEDIR"] = os.path.join(".", "local_cache")
+
+import json
+import math
+
+import dspy
+from dspy import Models
+from src.data_loaders import load_data
+from src.evaluators import supported_metrics
+from src.programs import InferRetrieveRank, supported_gates
+
+import argparse
+
+
+def calibrate_rank_gate(
+    program: InferRetrieveRank,
+    examples: list[dspy.Example],
+    metric_name: str,
+    batch_size: int = 32,
+    num_threads: int = 1,
+    n_thresholds: int = 20,
+) -> tuple[float, list[dict]]:
+    """Rank every example once, then simulate every gate at `n_thresholds` thresholds: skipped documents keep their retrieval ranking. Returns the metric of always ranking and one result per (gate, threshold)."""
+    metric = supported_metrics[metric_name]
+
+    # the outputs hold the Rank ordering as well as the retrieval ordering and its scores
+    outputs = []
+    for start in range(0, len(examples), batch_size):
+        batch = examples[start : start + batch_size]
+        outputs.extend(
+            program.forward_batch([e.text for e in batch], num_threads=num_threads)
+        )
+
+    ranked = [
+        metric(e, dspy.Prediction(predictions=o.predictions))
+        for e, o in zip(examples, outputs)
+    ]
+    retrieved = [
+        metric(e, dspy.Prediction(predictions=o.retrieved))
+        for e, o in zip(examples, outputs)
+    ]
+    baseline = 100 * sum(ranked) / len(ranked)
+
+    results = []
+    for gate_name, gate in supported_gates.items():
+        confidences = [gate(o.scores, program.rank_gate_k) for o in outputs]
+
+        # thresholds at evenly spaced quantiles of the confidences
+        ordered = sorted(confidences)
+        thresholds = sorted(
+            {
+                ordered[i * (len(ordered) - 1) // n_thresholds]
+                for i in range(n_thresholds + 1)
+            }
+        )
+        for threshold in thresholds:
+            skipped = [c >= threshold for c in confidences]
+            score = (
+                100
+                * sum(t if s else r for r, t, s in zip(ranked, retrieved, skipped))
+                / len(examples)
+            )
+            results.append(
+                {
+                    "rank_gate_name": gate_name,
+                    "rank_gate_threshold": threshold,
+                    "skipped": sum(skipped) / len(skipped),
+                    metric_name: round(score, 2),
+                    "delta": round(score - baseline, 2),
+                }
+            )
+    return round(baseline, 2), results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calibrate the confidence gate that skips Rank on a validation set: report the fraction of Rank calls avoided and the metric delta for every gate and threshold."
+    )
+
+    # Add arguments
+    parser.add_argument("--state_path", type=str)
+    parser.add_argument("--lm_config_path", type=str)
+    parser.add_argument(
+        "--dataset_name",
+        type=str,
+        help="Specify the dataset, its validation set is used",
+    )
+    parser.add_argument(
+        "--metric_name",
+        type=str,
+        default="rp10",
+        choices=list(supported_metrics),
+        help="Specify the metric to calibrate for (default: rp10)",
+    )
+    parser.add_argument(
+        "--max_drop",
+        type=float,
+        default=0.5,
+        help="Largest acceptable metric drop, in points, when picking a threshold (default: 0.5)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="Run the program in batches of this many examples (default: 32)",
+    )
+    parser.add_argument(
+        "--output_state_path",
+        type=str,
+        default=None,
+        help="Save the program state with the picked gate to this path (default: do not save)",
+    )
+
+    args = parser.parse_args()
+
+    Models(config_path=args.lm_config_path)
+
+    _, validation_examples, _, _, _, _ = load_data(args.dataset_name)
+
+    # always rank while calibrating
+    program = InferRetrieveRank.load(
+        args.state_path, rank_skip=False, rank_gate_name=None
+    )
+    baseline, results = calibrate_rank_gate(
+        program,
+        validation_examples,
+        args.metric_name,
+        batch_size=args.batch_size,
+        num_threads=int(os.environ.get("DSP_NUM_THREADS", 1)),
+    )
+
+    print(f"Always rank: {args.metric_name} {baseline}")
+    print(
+        f"{'gate':<8} {'threshold':>10} {'skipped':>8} {args.metric_name:>8} {'delta':>6}"
+    )
+    for result in results:
+        print(
+            f"{result['rank_gate_name']:<8} {result['rank_gate_threshold']:>10.4f} "
+            f"{result['skipped']:>8.1%} {result[args.metric_name]:>8.2f} {result['delta']:>6.2f}"
+        )
+
+    # the most Rank calls avoided within the acceptable drop
+    acceptable = [
+        r
+        for r in results
+        if r["delta"] >= -args.max_drop and math.isfinite(r["rank_gate_threshold"])
+    ]
+    if not acceptable:
+        print(f"No gate stays within a drop of {args.max_drop} points.")
+    else:
+        best = max(acceptable, key=lambda r: (r["skipped"], r["delta"]))
+        print(
+            f"Picked {best['rank_gate_name']} >= {best['rank_gate_threshold']:.4f}: "
+            f"skips {best['skipped']:.1%} of Rank calls, {args.metric_name} delta {best['delta']}"
+        )
+
+        if args.output_state_path:
+            with open(args.state_path, "r") as fp:
+                state = json.load(fp)
+            state["config"] |= {
+                "rank_gate_name": best["rank_gate_name"],
+                "rank_gate_threshold": best["rank_gate_threshold"],
+            }
+            with open(args.output_state_path, "w") as fp:
+                json.dump(state, fp)
+            print(f"Saved to {args.output_state_path}")
@@ -8,7 +8,14 @@ from src.data_loaders import load_data
 from src.programs import IreraConfig, InferRetrieveRank
 from src.optimizer import supported_optimizers
 from src.experiment import Experiment
-from src.evaluators import create_evaluators
+from src.evaluators import MultiEvaluate
+from src.lms import (
+    CachedLM,
+    LMCache,
+    configure_runner,
+    get_runner,
+    rate_limit_lm,
+)
 
 import argparse
 
@@ -34,6 +41,9 @@ def compile_irera(
     ontology_path: str,
     ontology_name: str,
     optimizer_name: str,
+    batch_size: int = None,
+    lm_cache_path: str = None,
+    optimizer_candidate_search: str = "random",
 ):
     # Create config
     config = IreraConfig(
@@ -47,6 +57,7 @@ def compile_irera(
         ontology_name=ontology_name,
         retriever_model_name=retriever_model_name,
         optimizer_name=optimizer_name,
+        optimizer_candidate_search=optimizer_candidate_search,
     )
 
     # load data (all of these files needed for the config could be dumped separately in one folder)
@@ -74,6 +85,27 @@ def compile_irera(
         },
     }
 
+    # keep every model within its rpm and tpm budget,
+    # every call made while compiling is optimization traffic
+    modules_to_lms = {
+        module: {
+            role: rate_limit_lm(lm, get_runner().limits, traffic_class="optimization")
+            for role, lm in lms.items()
+        }
+        for module, lms in modules_to_lms.items()
+    }
+
+    # answer LM calls from a shared cache, counting hits per module and role
+    lm_cache = LMCache(lm_cache_path) if lm_cache_path else None
+    if lm_cache:
+        modules_to_lms = {
+            module: {
+                role: CachedLM(lm, lm_cache, module=f"{module}.{role}")
+                for role, lm in lms.items()
+            }
+            for module, lms in modules_to_lms.items()
+        }
+
     program.infer_retrieve.infer.cot.lm = modules_to_lms["infer_retrieve.infer"][
         "student"
     ]
@@ -87,6 +119,7 @@ def compile_irera(
         "infer_compile_metric_name": infer_compile_metric_name,
         "rank_compile": rank_compile,
         "rank_compile_metric_name": rank_compile_metric_name,
+        "candidate_search": config.optimizer_candidate_search,
     }
     optimizer = optimizer_class(**optimizer_kwargs)
 
@@ -98,16 +131,19 @@ def compile_irera(
     # Validate / Test
     if do_validation:
         print("validating final program...")
-        validation_evaluators = create_evaluators(validation_examples)
-        validation_rp50 = validation_evaluators["rp50"](program)
-        validation_rp10 = validation_evaluators["rp10"](program)
-        validation_rp5 = validation_evaluators["rp5"](program)
+        # one pass over the examples scores every metric
+        validation_scores = MultiEvaluate(validation_examples, batch_size=batch_size)(
+            program
+        )
+        validation_rp50 = validation_scores["rp50"]
+        validation_rp10 = validation_scores["rp10"]
+        validation_rp5 = validation_scores["rp5"]
 
     if do_test:
         print("testing final program...")
-        test_evaluators = create_evaluators(test_examples)
-        test_rp10 = test_evaluators["rp10"](program)
-        test_rp5 = test_evaluators["rp5"](program)
+        test_scores = MultiEvaluate(test_examples, batch_size=batch_size)(program)
+        test_rp10 = test_scores["rp10"]
+        test_rp5 = test_scores["rp5"]
 
     if do_validation:
         print("Final program validation_rp50: ", validation_rp50)
@@ -118,6 +154,9 @@ def compile_irera(
         print("Final program test_rp10: ", test_rp10)
         print("Final program test_rp5: ", test_rp5)
 
+    if lm_cache:
+        print("LM cache hits per module: ", lm_cache.stats())
+
     exp = Experiment(
         dataset_name=dataset_name,
         program_name="infer-retrieve-rank",
@@ -132,8 +171,13 @@ def compile_irera(
         validation_rp5=validation_rp5 if do_validation else None,
         validation_rp10=validation_rp10 if do_validation else None,
         validation_rp50=validation_rp50 if do_validation else None,
+        validation_recall5=validation_scores["recall5"] if do_validation else None,
+        validation_recall10=validation_scores["recall10"] if do_validation else None,
         test_rp5=test_rp5 if do_test else None,
         test_rp10=test_rp10 if do_test else None,
+        test_rp50=test_scores["rp50"] if do_test else None,
+        test_recall5=test_scores["recall5"] if do_test else None,
+        test_recall10=test_scores["recall10"] if do_test else None,
         program_state=program.dump_state(),
         optimizer_name=optimizer_name,
     )
@@ -223,6 +267,32 @@ if __name__ == "__main__":
 
     parser.add_argument("--ontology_name", type=str, help="Name of the ontology.")
     parser.add_argument("--optimizer_name", type=str, help="Name of the ontology.")
+    parser.add_argument(
+        "--optimizer_candidate_search",
+        type=str,
+        default="random",
+        choices=["random", "successive-halving"],
+        help="Score every candidate program on the full validation set (random), or only the promising ones by successive halving (default: random)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="Evaluate the final program in batches of this many examples, encoding their retrieval queries together (default: one example at a time)",
+    )
+
+    parser.add_argument(
+        "--lm_limits_path",
+        type=str,
+        default=None,
+        help="JSON file with concurrency, rpm and tpm limits per model, e.g. ./lm_limits.json (default: no rpm or tpm limits)",
+    )
+    parser.add_argument(
+        "--lm_cache_path",
+        type=str,
+        default=None,
+        help="SQLite file to cache LM completions in, shared between runs and processes (default: no cache)",
+    )
 
     # parser.add_argument(
     #     "--max_windows",
@@ -257,6 +327,10 @@ if __name__ == "__main__":
     ontology_path = args.ontology_path
     ontology_name = args.ontology_name
     optimizer_name = args.optimizer_name
+    optimizer_candidate_search = args.optimizer_candidate_search
+    batch_size = args.batch_size
+    lm_cache_path = args.lm_cache_path
+    lm_limits_path = args.lm_limits_path
 
     print(f"dataset_name: ", dataset_name)
     print(f"retriever_model_name: ", retriever_model_name)
@@ -279,9 +353,14 @@ if __name__ == "__main__":
     print(f"ontology_path: ", ontology_path)
     print(f"ontology_name: ", ontology_name)
     print(f"optimizer_name: ", optimizer_name)
+    print(f"optimizer_candidate_search: ", optimizer_candidate_search)
+    print(f"batch_size: ", batch_size)
+    print(f"lm_cache_path: ", lm_cache_path)
+    print(f"lm_limits_path: ", lm_limits_path)
 
 
     Models(config_path=lm_config_path)
+    configure_runner(lm_limits_path)
 
     experiment, program = compile_irera(
         dataset_name,
@@ -305,5 +384,8 @@ if __name__ == "__main__":
         ontology_path,
         ontology_name,
         optimizer_name,
+        batch_size,
+        lm_cache_path,
+        optimizer_candidate_search,
     )
     experiment.save("./results")
@@ -3,13 +3,32 @@ os.environ["DSP_NOTEBOOK_CACHEDIR"] = os.path.join(".", "local_cache")
 
 from dspy import Models
 from src.data_loaders import load_data
-from src.evaluators import create_evaluators
+from src.evaluators import MultiEvaluate
+from src.predictions import PredictionStore
+from src.lms import (
+    LMCache,
+    batch_lms,
+    cache_lms,
+    configure_runner,
+    get_runner,
+    rate_limit_lms,
+)
 from src.programs import InferRetrieveRank
 
 import argparse
 
 
-def run_irera(state_path, dataset_name, do_validation, do_test):
+def run_irera(
+    state_path,
+    dataset_name,
+    do_validation,
+    do_test,
+    batch_size=None,
+    use_async=False,
+    lm_cache_path=None,
+    pipeline_workers=None,
+    predictions_path=None,
+):
     # load data (all of these files needed for the config could be dumped separately in one folder)
     (
         _,
@@ -23,19 +42,51 @@ def run_irera(state_path, dataset_name, do_validation, do_test):
     # load program
     program = InferRetrieveRank.load(state_path)
 
+    # the wrappers below cover every predictor and the Rank cascade model, see `lm_holders`
+    # micro-batch the prompts of models with a `max_batch_size` in the LM limits
+    batch_lms(program, get_runner().limits)
+
+    # keep every model within its rpm and tpm budget, retrying rate limited calls
+    rate_limit_lms(program, get_runner().limits)
+
+    # answer LM calls from a shared cache, counting hits per module
+    lm_cache = LMCache(lm_cache_path) if lm_cache_path else None
+    if lm_cache:
+        cache_lms(program, lm_cache)
+
+    # stream every prediction to disk, and skip the examples a previous run finished
+    store = PredictionStore(predictions_path) if predictions_path else None
+
     # Validate / Test
     if do_validation:
         print("validating final program...")
-        validation_evaluators = create_evaluators(validation_examples)
-        validation_rp50 = validation_evaluators["rp50"](program)
-        validation_rp10 = validation_evaluators["rp10"](program)
-        validation_rp5 = validation_evaluators["rp5"](program)
+        # one pass over the examples scores every metric
+        validation_scores = MultiEvaluate(
+            validation_examples,
+            batch_size=batch_size,
+            use_async=use_async,
+            pipeline_workers=pipeline_workers,
+            store=store,
+        )(program)
+        validation_rp50 = validation_scores["rp50"]
+        validation_rp10 = validation_scores["rp10"]
+        validation_rp5 = validation_scores["rp5"]
 
     if do_test:
         print("testing final program...")
-        test_evaluators = create_evaluators(test_examples)
-        test_rp10 = test_evaluators["rp10"](program)
-        test_rp5 = test_evaluators["rp5"](program)
+        test_evaluate = MultiEvaluate(
+            test_examples,
+            batch_size=batch_size,
+            use_async=use_async,
+            pipeline_workers=pipeline_workers,
+            store=store,
+        )
+        test_scores = test_evaluate(program)
+        test_rp10 = test_scores["rp10"]
+        test_rp5 = test_scores["rp5"]
+
+        # every K from the same predictions, with 95% bootstrap intervals
+        test_sweep = test_evaluate.sweep()
 
     if do_validation:
         print("Final program validation_rp50: ", validation_rp50)
@@ -45,6 +96,30 @@ def run_irera(state_path, dataset_name, do_validation, do_test):
     if do_test:
         print("Final program test_rp10: ", test_rp10)
         print("Final program test_rp5: ", test_rp5)
+        for k in [1, 5, 10, 20, 50]:
+            print(
+                f"Final program test RP@{k}: {test_sweep['rp'][k - 1]:.2f} "
+                f"[{test_sweep['rp_low'][k - 1]:.2f}, {test_sweep['rp_high'][k - 1]:.2f}], "
+                f"Recall@{k}: {test_sweep['recall'][k - 1]:.2f} "
+                f"[{test_sweep['recall_low'][k - 1]:.2f}, {test_sweep['recall_high'][k - 1]:.2f}]"
+            )
+
+    if do_test:
+        test_predictions = [p for p in test_evaluate.predictions if p is not None]
+        print(
+            "Queries matched to an ontology term without encoding, per document: ",
+            round(
+                sum(p.exact_matches for p in test_predictions)
+                / max(len(test_predictions), 1),
+                2,
+            ),
+        )
+
+    if program.rank_gate_name or program.rank.cascade_model_name:
+        print("Rank routes: ", program.rank_routes.fractions())
+
+    if lm_cache:
+        print("LM cache hits per module: ", lm_cache.stats())
 
     return program
 
@@ -72,6 +147,47 @@ if __name__ == "__main__":
         action="store_true",
         help="Specify if test results need to be calculated (default: False)",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="Evaluate in batches of this many examples, encoding their retrieval queries together (default: one example at a time)",
+    )
+
+    parser.add_argument(
+        "--use_async",
+        action="store_true",
+        help="Evaluate all examples concurrently on one event loop, with LM concurrency bounded per model (default: False)",
+    )
+    parser.add_argument(
+        "--lm_limits_path",
+        type=str,
+        default=None,
+        help="JSON file with concurrency, rpm and tpm limits per model, e.g. ./lm_limits.json (default: 8 concurrent requests per model, no rpm or tpm limits)",
+    )
+
+    parser.add_argument(
+        "--lm_cache_path",
+        type=str,
+        default=None,
+        help="SQLite file to cache LM completions in, shared between runs and processes (default: no cache)",
+    )
+
+    parser.add_argument(
+        "--pipeline_workers",
+        type=int,
+        nargs=3,
+        default=None,
+        metavar=("INFER", "RETRIEVE", "RANK"),
+        help="Stream examples through a pipeline with this many infer, retrieve and rank workers, e.g. 8 1 8 (default: no pipeline)",
+    )
+
+    parser.add_argument(
+        "--predictions_path",
+        type=str,
+        default=None,
+        help="JSON lines file to append every prediction to; a rerun of the same program skips the examples it already holds (default: do not store)",
+    )
 
     # Parse the command-line arguments
     args = parser.parse_args()
@@ -81,14 +197,37 @@ if __name__ == "__main__":
     dataset_name = args.dataset_name
     do_validation = args.do_validation
     do_test = args.do_test
+    batch_size = args.batch_size
+    use_async = args.use_async
+    lm_limits_path = args.lm_limits_path
+    lm_cache_path = args.lm_cache_path
+    pipeline_workers = args.pipeline_workers
+    predictions_path = args.predictions_path
 
     print("state_path: ", state_path)
     print("lm_config_path: ", lm_config_path)
     print("dataset_name: ", dataset_name)
     print("do_validation: ", do_validation)
     print("do_test: ", do_test)
+    print("batch_size: ", batch_size)
+    print("use_async: ", use_async)
+    print("lm_limits_path: ", lm_limits_path)
+    print("lm_cache_path: ", lm_cache_path)
+    print("pipeline_workers: ", pipeline_workers)
+    print("predictions_path: ", predictions_path)
 
 
     Models(config_path=lm_config_path)
-
-    program = run_irera(state_path, dataset_name, do_validation, do_test)
+    configure_runner(lm_limits_path)
+
+    program = run_irera(
+        state_path,
+        dataset_name,
+        do_validation,
+        do_test,
+        batch_size,
+        use_async,
+        lm_cache_path,
+        pipeline_workers,
+        predictions_path,
+    )
@@ -1,6 +1,81 @@
-from .data_loaders import *
-from .evaluators import *
-from .experiment import *
-from .metrics import *
-from .utils import *
-from .programs import *
+import importlib
+
+""" Submodules are imported on first attribute access, so e.g. `from src.programs import InferRetrieveRank` does not pull in pandas and datasets through the data loaders.
+"""
+
+# the names re-exported by every submodule
+_exports = {
+    "data_loaders": ["load_data"],
+    "evaluators": [
+        "num_threads",
+        "dspy_metric_rp50",
+        "dspy_metric_rp10",
+        "dspy_metric_rp5",
+        "dspy_metric_rp1",
+        "dspy_metric_recall10",
+        "dspy_metric_recall5",
+        "dspy_metric_recall1",
+        "MultiEvaluate",
+        "create_evaluators",
+        "supported_metrics",
+    ],
+    "experiment": ["Experiment"],
+    "metrics": ["rp_at_k", "recall_at_k"],
+    "utils": [
+        "normalize",
+        "extract_labels_from_string",
+        "extract_labels_from_strings",
+        "SQLiteConnections",
+    ],
+    "programs": [
+        "Chunker",
+        "IreraConfig",
+        "RoutingStats",
+        "supported_gates",
+        "Infer",
+        "Rank",
+        "Ontology",
+        "load_ontology",
+        "Retriever",
+        "load_retriever",
+        "InferRetrieve",
+        "InferRetrieveRank",
+        "supported_signatures",
+    ],
+    "lms": [
+        "LMRunner",
+        "ModelLimits",
+        "configure_runner",
+        "get_runner",
+        "lm_holders",
+        "model_name",
+        "LMWrapper",
+        "BatchedLM",
+        "MicroBatcher",
+        "batch_lms",
+        "CachedLM",
+        "LMCache",
+        "cache_lms",
+        "RateLimitedLM",
+        "RateLimiter",
+        "rate_limit_lm",
+        "rate_limit_lms",
+    ],
+}
+_submodule_of = {
+    name: submodule for submodule, names in _exports.items() for name in names
+}
+
+__all__ = list(_submodule_of)
+
+
+def __getattr__(name):
+    # only the submodule that defines `name` is imported
+    if name not in _submodule_of:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f".{_submodule_of[name]}", __name__)
+    return getattr(module, name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
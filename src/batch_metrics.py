@@ -0,0 +1,112 @@
+import numpy as np
+
+""" Vectorized versions of the metrics of `src/metrics.py`, for many examples and every K at once. Labels are encoded as integer ids, and RP@K and Recall@K for all examples and all K up to `max_k` come from one cumulative sum over a (examples, max_k) hit matrix.
+"""
+
+
+def encode(
+    gold: list[list[str]],
+    predicted: list[list[str]],
+    max_k: int,
+    label_to_id: dict[str, int] = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Integer ids of the gold labels, padded with -1, and of the top `max_k` predicted labels, padded with -2. Ids come from `label_to_id`, e.g. `Ontology.term_to_index`, or are assigned to the gold labels in order. Predicted labels that are no gold label of any example get -2, since they can never be a hit."""
+    label_to_id = dict(label_to_id or {})
+    # ids of `label_to_id` need not be contiguous, e.g. when ontology terms repeat
+    next_id = max(label_to_id.values(), default=-1) + 1
+    for labels in gold:
+        for label in labels:
+            if label not in label_to_id:
+                label_to_id[label] = next_id
+                next_id += 1
+
+    gold_ids = np.full((len(gold), max((len(g) for g in gold), default=0)), -1)
+    for i, labels in enumerate(gold):
+        gold_ids[i, : len(labels)] = [label_to_id[label] for label in labels]
+
+    predicted_ids = np.full((len(predicted), max_k), -2)
+    for i, labels in enumerate(predicted):
+        labels = labels[:max_k]
+        predicted_ids[i, : len(labels)] = [label_to_id.get(l, -2) for l in labels]
+
+    return gold_ids, predicted_ids
+
+
+def hits(gold_ids: np.ndarray, predicted_ids: np.ndarray) -> np.ndarray:
+    """(examples, max_k) booleans: is the predicted label at every rank a gold label?"""
+    return (predicted_ids[:, :, None] == gold_ids[:, None, :]).any(axis=2)
+
+
+def rp_at_ks(gold_ids: np.ndarray, predicted_ids: np.ndarray) -> np.ndarray:
+    """(examples, max_k) RP@K for K = 1..max_k, as `metrics.rp_at_k`."""
+    true_positives = hits(gold_ids, predicted_ids).cumsum(axis=1)
+    n_gold = (gold_ids >= 0).sum(axis=1)
+    ks = np.arange(1, predicted_ids.shape[1] + 1)
+    denominator = np.minimum(ks[None, :], n_gold[:, None])
+    return np.divide(
+        true_positives,
+        denominator,
+        out=np.zeros(true_positives.shape),
+        where=denominator > 0,
+    )
+
+
+def recall_at_ks(gold_ids: np.ndarray, predicted_ids: np.ndarray) -> np.ndarray:
+    """(examples, max_k) Recall@K for K = 1..max_k, as `metrics.recall_at_k`. Examples without gold labels score 0."""
+    true_positives = hits(gold_ids, predicted_ids).cumsum(axis=1)
+    n_gold = (gold_ids >= 0).sum(axis=1)[:, None]
+    return np.divide(
+        true_positives,
+        n_gold,
+        out=np.zeros(true_positives.shape),
+        where=n_gold > 0,
+    )
+
+
+def bootstrap_ci(
+    scores: np.ndarray,
+    n_resamples: int = 1000,
+    confidence: float = 0.95,
+    seed: int = 42,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Percentile bootstrap interval of the mean of every column of (examples, K) `scores`. All resamples are drawn as one (n_resamples, examples) matrix of counts, so their means are one matrix product."""
+    rng = np.random.default_rng(seed)
+    n = len(scores)
+    if n == 0:
+        return np.zeros(scores.shape[1]), np.zeros(scores.shape[1])
+    samples = rng.integers(0, n, size=(n_resamples, n))
+    # how often every example was drawn in every resample
+    offsets = samples + n * np.arange(n_resamples)[:, None]
+    counts = np.bincount(offsets.ravel(), minlength=n_resamples * n)
+    means = counts.reshape(n_resamples, n).astype(scores.dtype) @ scores / n
+    alpha = (1.0 - confidence) / 2
+    return np.quantile(means, alpha, axis=0), np.quantile(means, 1.0 - alpha, axis=0)
+
+
+def evaluate(
+    gold: list[list[str]],
+    predicted: list[list[str]],
+    max_k: int = 50,
+    n_resamples: int = 1000,
+    confidence: float = 0.95,
+    label_to_id: dict[str, int] = None,
+) -> dict[str, np.ndarray]:
+    """Mean RP@K and Recall@K over all examples for K = 1..max_k, as percentages, with bootstrap confidence intervals. Every value is an array indexed by K - 1, and 0 without examples."""
+    gold_ids, predicted_ids = encode(gold, predicted, max_k, label_to_id)
+    scores = {
+        "rp": rp_at_ks(gold_ids, predicted_ids),
+        "recall": recall_at_ks(gold_ids, predicted_ids),
+    }
+
+    # one bootstrap for both metrics: the resamples are the most expensive part
+    low, high = bootstrap_ci(
+        np.concatenate(list(scores.values()), axis=1), n_resamples, confidence
+    )
+
+    results = {"k": np.arange(1, max_k + 1)}
+    for i, (name, values) in enumerate(scores.items()):
+        columns = slice(i * max_k, (i + 1) * max_k)
+        results[name] = 100 * (values.mean(axis=0) if len(values) else np.zeros(max_k))
+        results[f"{name}_low"] = 100 * low[columns]
+        results[f"{name}_high"] = 100 * high[columns]
+    return results
@@ -0,0 +1,139 @@
+import math
+
+import dspy
+from dspy.evaluate import Evaluate
+from dspy.teleprompt import BootstrapFewShotWithRandomSearch
+
+""" Ways to pick the best of the candidate programs of a few-shot random search. `BootstrapFewShotWithRandomSearch` scores every candidate on the full validation set, successive halving only scores the promising ones on all of it.
+"""
+
+
+class BootstrapFewShotWithSuccessiveHalving(BootstrapFewShotWithRandomSearch):
+    """Builds the same candidate programs as `BootstrapFewShotWithRandomSearch`, but scores them by successive halving.
+
+    All candidates are scored on the first `min_slice_size` validation examples, the best `1 / eta` of them survive and are scored on a slice `eta` times as large, until the slice is the full validation set. On the full validation set, candidates race: the most promising goes first, and a candidate is dropped as soon as it can no longer beat the best full score, even if it scored `max_example_score` on every remaining example. Per-example scores are kept, so a survivor is only scored on the examples that were added to the slice.
+    """
+
+    def __init__(
+        self,
+        metric,
+        min_slice_size: int = 8,
+        eta: int = 2,
+        max_example_score: float = 1.0,
+        **kwargs,
+    ):
+        super().__init__(metric=metric, **kwargs)
+        self.min_slice_size = min_slice_size
+        self.eta = eta
+        self.max_example_score = max_example_score
+
+        # validation examples scored in the last search
+        self.evaluations = 0
+
+    def compile(
+        self,
+        student,
+        *,
+        teacher=None,
+        trainset,
+        valset=None,
+        restrict=None,
+        **kwargs,
+    ) -> dspy.Module:
+        valset = valset or trainset
+
+        # the candidates of the random search: zero-shot, labeled, unshuffled and shuffled bootstraps
+        seeds = [
+            seed
+            for seed in range(-3, self.num_candidate_sets)
+            if restrict is None or seed in restrict
+        ]
+        candidates = []
+        for seed in seeds:
+            # the random search builds the candidate of one seed, scoring it on one example only
+            candidates.append(
+                super().compile(
+                    student,
+                    teacher=teacher,
+                    trainset=trainset,
+                    valset=valset[:1],
+                    restrict=[seed],
+                    **kwargs,
+                )
+            )
+
+        scores = [[] for _ in candidates]
+        alive = list(range(len(candidates)))
+        best, best_score = None, -math.inf
+        size = min(self.min_slice_size, len(valset))
+        # including the example the random search scored every candidate on
+        self.evaluations = len(candidates)
+
+        while True:
+            final = size == len(valset)
+            if final:
+                # race the most promising candidates first, so the best score rises early
+                alive.sort(key=lambda i: -self._mean(scores[i]))
+
+            survivors = []
+            for i in alive:
+                while len(scores[i]) < size:
+                    end = min(size, len(scores[i]) + self.min_slice_size)
+                    self._extend(candidates[i], scores[i], valset[len(scores[i]) : end])
+                    if self._upper_bound(scores[i], len(valset)) <= best_score:
+                        break
+                else:
+                    survivors.append(i)
+                    if final and self._mean(scores[i]) > best_score:
+                        best, best_score = i, self._mean(scores[i])
+
+            # the last survivor is the best, without scoring it further
+            if final or len(survivors) == 1:
+                best = survivors[0] if best is None else best
+                break
+            survivors.sort(key=lambda i: -self._mean(scores[i]))
+            alive = survivors[: math.ceil(len(survivors) / self.eta)]
+            size = min(size * self.eta, len(valset))
+
+        print(
+            f"Successive halving: scored {self.evaluations} validation examples, "
+            f"{len(candidates) * len(valset)} for a full search"
+        )
+
+        program = candidates[best]
+        program.candidate_programs = sorted(
+            [
+                (100 * self._mean(s), s, seed, c)
+                for s, seed, c in zip(scores, seeds, candidates)
+            ],
+            key=lambda x: (len(x[1]), x[0]),
+            reverse=True,
+        )
+        return program
+
+    def _extend(self, program: dspy.Module, scores: list[float], examples: list):
+        """Score `program` on `examples` and append their scores."""
+        evaluate = Evaluate(
+            devset=examples,
+            metric=self.metric,
+            num_threads=self.num_threads,
+            max_errors=self.max_errors,
+            display_table=False,
+            display_progress=False,
+        )
+        _, example_scores = evaluate(program, return_all_scores=True)
+        scores.extend(example_scores)
+        self.evaluations += len(examples)
+
+    def _upper_bound(self, scores: list[float], n: int) -> float:
+        """The best mean score over `n` examples that is still possible."""
+        return (sum(scores) + (n - len(scores)) * self.max_example_score) / n
+
+    def _mean(self, scores: list[float]) -> float:
+        return sum(scores) / len(scores) if scores else 0.0
+
+
+supported_candidate_searches = {
+    "random": BootstrapFewShotWithRandomSearch,
+    "successive-halving": BootstrapFewShotWithSuccessiveHalving,
+}
@@ -1,6 +1,11 @@
-from dspy import Example
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from dspy import Example, Prediction
 from dspy.evaluate import Evaluate
 from src.metrics import *
+import src.batch_metrics as batch_metrics
+from src.predictions import PredictionStore, example_id, program_hash
 import os
 
 num_threads = os.environ.get('DSP_NUM_THREADS', 1)
@@ -38,6 +43,167 @@ def dspy_metric_recall1(gold: Example, pred, trace=None) -> float:
     return recall_at_k(gold.label, pred.predictions, 1)
 
 
+class MultiEvaluate:
+    """Runs a program once per example, keeps the predictions and computes every metric from them, so evaluating N metrics costs one pass over the devset instead of N.
+
+    Examples run on `num_threads` threads, as with `Evaluate`, unless the program is run in batches of `batch_size` (`forward_batch`), on one event loop (`use_async`, `aforward_batch`) or as a pipeline with (infer, retrieve, rank) `pipeline_workers` (`forward_pipelined`). Examples whose prediction fails score 0, up to `max_errors` of them.
+
+    With a `store`, every finished example is appended to it as soon as it is predicted, and examples the same program already finished are read from it instead of being run again.
+    """
+
+    def __init__(
+        self,
+        devset,
+        metrics=None,
+        num_threads=num_threads,
+        batch_size=None,
+        use_async=False,
+        pipeline_workers=None,
+        max_errors=100,
+        store: PredictionStore = None,
+    ):
+        self.devset = devset
+        self.metrics = metrics or supported_metrics
+        self.num_threads = int(num_threads)
+        self.batch_size = batch_size
+        self.use_async = use_async
+        self.pipeline_workers = pipeline_workers
+        self.max_errors = max_errors
+        self.store = store
+
+        # predictions of the last evaluated program, aligned with `devset`
+        self.predictions = None
+
+    def predict(self, program) -> list:
+        if self.store is None:
+            return self._predict(program, self.devset)
+
+        program_id = program_hash(program)
+        completed = self.store.completed(program_id)
+        todo = [e for e in self.devset if example_id(e) not in completed]
+        if len(todo) < len(self.devset):
+            print(
+                f"Resuming {program_id}: {len(self.devset) - len(todo)} of "
+                f"{len(self.devset)} examples already predicted"
+            )
+
+        def save(example, prediction, error=None):
+            self.store.append(
+                program_id,
+                example,
+                prediction.toDict() if prediction is not None else None,
+                error,
+            )
+
+        predictions = dict(
+            zip(
+                map(example_id, todo),
+                self._predict(program, todo, save) if todo else [],
+            )
+        )
+        return [
+            predictions[id]
+            if id in predictions
+            else Prediction(**completed[id]["prediction"])
+            for id in map(example_id, self.devset)
+        ]
+
+    def _predict(self, program, examples: list, save=None) -> list:
+        """Predictions for `examples`. `save` is called with every example and its prediction, or the error it raised, as soon as it is done."""
+        save = save or (lambda example, prediction, error=None: None)
+        texts = [example.text for example in examples]
+        predictions = [None] * len(examples)
+        errors = []
+
+        def done(index, result):
+            # a failed example is recorded and predicts nothing, until `max_errors` examples failed
+            if isinstance(result, BaseException):
+                save(examples[index], None, result)
+                errors.append(result)
+                if len(errors) >= self.max_errors:
+                    raise result
+                return
+            save(examples[index], result)
+            predictions[index] = result
+
+        if self.pipeline_workers:
+            infer_workers, retrieve_workers, rank_workers = self.pipeline_workers
+            program.forward_pipelined(
+                texts,
+                infer_workers=infer_workers,
+                retrieve_workers=retrieve_workers,
+                rank_workers=rank_workers,
+                return_exceptions=True,
+                on_result=done,
+            )
+            print("Pipeline stages: ", program.pipeline_stats)
+            return predictions
+
+        if self.use_async:
+
+            async def arun(index):
+                try:
+                    result = await program.aforward(texts[index])
+                except Exception as e:
+                    result = e
+                done(index, result)
+
+            async def run_all():
+                await asyncio.gather(*map(arun, range(len(examples))))
+
+            asyncio.run(run_all())
+            return predictions
+
+        if self.batch_size:
+            for start in range(0, len(texts), self.batch_size):
+                program.forward_batch(
+                    texts[start : start + self.batch_size],
+                    num_threads=self.num_threads,
+                    return_exceptions=True,
+                    on_result=lambda index, result: done(start + index, result),
+                )
+            return predictions
+
+        def run(index):
+            try:
+                result = program(**examples[index].inputs())
+            except Exception as e:
+                result = e
+            done(index, result)
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            list(executor.map(run, range(len(examples))))
+        return predictions
+
+    def __call__(self, program) -> dict[str, float]:
+        """Score of every metric, as a percentage."""
+        self.predictions = self.predict(program)
+        return {
+            name: round(
+                100
+                * sum(
+                    metric(example, prediction) if prediction is not None else 0.0
+                    for example, prediction in zip(self.devset, self.predictions)
+                )
+                / len(self.devset),
+                2,
+            )
+            for name, metric in self.metrics.items()
+        }
+
+    def sweep(self, max_k: int = 50, n_resamples: int = 1000) -> dict:
+        """RP@K and Recall@K for K = 1..max_k of the last evaluated program, with bootstrap confidence intervals."""
+        return batch_metrics.evaluate(
+            [example.label for example in self.devset],
+            [
+                prediction.predictions if prediction is not None else []
+                for prediction in self.predictions
+            ],
+            max_k=max_k,
+            n_resamples=n_resamples,
+        )
+
+
 def create_evaluators(examples):
     # create a suite of DSPy evaluators based on a set of examples
     evaluate_recall10 = Evaluate(
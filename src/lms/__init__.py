@@ -0,0 +1,12 @@
+from .concurrency import (
+    LMRunner,
+    ModelLimits,
+    configure_runner,
+    get_runner,
+    lm_holders,
+    model_name,
+)
+from .wrapper import LMWrapper
+from .batching import BatchedLM, MicroBatcher, batch_lms
+from .cache import CachedLM, LMCache, cache_lms
+from .rate_limit import RateLimitedLM, RateLimiter, rate_limit_lm, rate_limit_lms
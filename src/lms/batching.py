@@ -0,0 +1,236 @@
+import json
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .concurrency import ModelLimits, lm_holders, model_name
+from .wrapper import LMWrapper
+
+# options of an LM client that are not sent as generation parameters
+_client_options = ["url", "port", "model", "only_completed", "return_sorted"]
+
+
+class MicroBatcher:
+    """Collects concurrent prompts for one endpoint and sends them as one request.
+
+    A batch is sent when it holds `max_batch_size` prompts or `max_wait_ms` after its first prompt arrived, whichever comes first. Only prompts with the same generation parameters share a batch. Up to `max_batches_in_flight` batches are sent concurrently, so collecting the next batch never waits for the previous one.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        model: str,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10,
+        max_batches_in_flight: int = 4,
+        timeout: float = 120,
+    ):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.timeout = timeout
+
+        self.batch_sizes = []
+        self._queue = queue.Queue()
+        self._senders = ThreadPoolExecutor(
+            max_workers=max_batches_in_flight, thread_name_prefix="batch"
+        )
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def submit(self, prompt: str, **kwargs) -> Future:
+        """Queue a prompt. The future resolves to the list of its `n` completions."""
+        future = Future()
+        self._queue.put((prompt, kwargs, future))
+        return future
+
+    def _collect(self):
+        while True:
+            pending = {}
+            item = self._queue.get()
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while True:
+                key = json.dumps(item[1], sort_keys=True)
+                batch = pending.setdefault(key, [])
+                batch.append(item)
+                if len(batch) >= self.max_batch_size:
+                    self._senders.submit(self._send, pending.pop(key))
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+            for batch in pending.values():
+                self._senders.submit(self._send, batch)
+
+    def _send(self, batch: list):
+        prompts = [prompt for prompt, _, _ in batch]
+        kwargs = batch[0][1]
+        n = kwargs.get("n", 1)
+        self.batch_sizes.append(len(batch))
+        try:
+            request = urllib.request.Request(
+                f"{self.url}/v1/completions",
+                data=json.dumps(
+                    {"model": self.model, "prompt": prompts, **kwargs}
+                ).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                choices = json.load(response)["choices"]
+
+            completions = [[] for _ in batch]
+            choices = sorted(choices, key=lambda c: c["index"])
+            for choice in choices:
+                completions[choice["index"] // n].append(choice["text"])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), texts in zip(batch, completions):
+            future.set_result(texts)
+
+
+class BatchedLM(LMWrapper):
+    """Sends the prompts of an LM client through a `MicroBatcher`.
+
+    The endpoint must accept a list of prompts in one OpenAI-style `/v1/completions` request, as vLLM and most self-hosted llama servers do. Generation parameters are taken from the wrapped client.
+    """
+
+    def __init__(self, lm, batcher: MicroBatcher):
+        super().__init__(lm)
+        self.batcher = batcher
+
+    def __call__(self, prompt: str, **kwargs) -> list[str]:
+        kwargs = {
+            key: value
+            for key, value in (self.lm.kwargs | kwargs).items()
+            if key not in _client_options
+        }
+        completions = self.batcher.submit(prompt, **kwargs).result()
+        self._record(prompt, completions, kwargs)
+        return completions
+
+
+def batch_lms(program, limits: ModelLimits):
+    """Replace the LM of every predictor and LM holder in `program` whose model has a `max_batch_size` above 1 in `limits` by a `BatchedLM`. Predictors that use the same model share one batcher."""
+    batched = {}
+    for _, predictor in lm_holders(program):
+        lm = predictor.lm
+        if lm is None or isinstance(lm, BatchedLM):
+            continue
+        model = model_name(lm)
+        if limits.get(model, "max_batch_size", 1) <= 1:
+            continue
+        if model not in batched:
+            batched[model] = BatchedLM(
+                lm,
+                MicroBatcher(
+                    limits.get(model, "batch_url", lm.kwargs.get("url")),
+                    model,
+                    max_batch_size=limits.get(model, "max_batch_size"),
+                    max_wait_ms=limits.get(model, "max_wait_ms", 10),
+                    max_batches_in_flight=limits.get(model, "max_batches_in_flight", 4),
+                ),
+            )
+        predictor.lm = batched[model]
+    return program
+
+
+def serve_stub(port: int, latency_ms: float = 50):
+    """Serve a stub `/v1/completions` endpoint that answers every prompt after a fixed latency, regardless of the batch size. Logs the size of every batch."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            prompts = body["prompt"]
+            prompts = prompts if isinstance(prompts, list) else [prompts]
+            n = body.get("n", 1)
+            print(f"batch of {len(prompts)} prompts")
+            time.sleep(latency_ms / 1000)
+
+            choices = [
+                {"index": i * n + j, "text": f" completion {j} of {p}"}
+                for i, p in enumerate(prompts)
+                for j in range(n)
+            ]
+            response = json.dumps({"choices": choices}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer(("localhost", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run the stub completion server, or send concurrent prompts through the micro-batcher to a server and report batch sizes and latency."
+    )
+
+    # Add arguments
+    parser.add_argument("--serve", action="store_true", help="Run the stub server.")
+    parser.add_argument(
+        "--port", type=int, default=8089, help="Stub server port (default: 8089)"
+    )
+    parser.add_argument(
+        "--url",
+        type=str,
+        default="http://localhost:8089",
+        help="Endpoint to send prompts to (default: the stub server)",
+    )
+    parser.add_argument(
+        "--n_prompts",
+        type=int,
+        default=256,
+        help="Number of concurrent prompts (default: 256)",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=16,
+        help="Maximum number of prompts per request (default: 16)",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10,
+        help="Time to wait for a batch to fill up (default: 10)",
+    )
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_stub(args.port)
+    else:
+        batcher = MicroBatcher(
+            args.url,
+            "stub",
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+        )
+        start = time.perf_counter()
+        futures = [
+            batcher.submit(f"prompt {i}", max_tokens=10, n=1)
+            for i in range(args.n_prompts)
+        ]
+        completions = [f.result() for f in futures]
+        elapsed = time.perf_counter() - start
+
+        # every completion was routed back to its own prompt
+        assert all(c[0].endswith(f"prompt {i}") for i, c in enumerate(completions))
+        batch_sizes = batcher.batch_sizes
+        print(f"{args.n_prompts} prompts in {len(batch_sizes)} batches, {elapsed:.2f}s")
+        print(f"mean batch size: {sum(batch_sizes) / len(batch_sizes):.1f}")
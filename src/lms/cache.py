@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from src.utils import SQLiteConnections
+from .concurrency import lm_holders
+from .wrapper import LMWrapper
+
+# options of an LM client that do not change its completions
+_transport_options = ["url", "port", "api_base", "api_key"]
+
+
+class LMCache:
+    """Persistent cache of LM completions in one SQLite file, keyed by a hash of the model config, the prompt and the decoding parameters.
+
+    Several threads and processes can read and write the same file at once. Caches from several machines are combined with `merge`, and `evict` drops the least recently used completions until the file is below a size. Hits and misses are counted per module.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = None):
+        self.path = path
+        self.max_size_mb = max_size_mb
+
+        self._connections = SQLiteConnections(path)
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self._puts = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connections.get().execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, model TEXT, prompt TEXT, kwargs TEXT, "
+            "completions TEXT, size INTEGER, last_used REAL)"
+        )
+
+    @staticmethod
+    def key(prompt: str, kwargs: dict) -> str:
+        """Hash of the prompt and the options of the call, including the model."""
+        content = json.dumps({"prompt": prompt, "kwargs": kwargs}, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, module: str = None) -> list[str]:
+        """Completions stored for `key`, None if there are none."""
+        connection = self._connections.get()
+        row = connection.execute(
+            "SELECT completions FROM completions WHERE key = ?", [key]
+        ).fetchone()
+        if row is not None:
+            connection.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ?",
+                [time.time(), key],
+            )
+
+        with self._lock:
+            self._stats[module]["hits" if row is not None else "misses"] += 1
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key: str, prompt: str, kwargs: dict, completions: list[str]):
+        completions = json.dumps(completions)
+        self._connections.get().execute(
+            "INSERT OR IGNORE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                key,
+                kwargs.get("model"),
+                prompt,
+                json.dumps(kwargs, sort_keys=True),
+                completions,
+                len(prompt) + len(completions),
+                time.time(),
+            ],
+        )
+
+        # check the size every so often, not on every write
+        with self._lock:
+            self._puts += 1
+            check_size = self.max_size_mb is not None and self._puts % 1000 == 0
+        if check_size:
+            self.evict(self.max_size_mb)
+
+    def merge(self, path: str) -> int:
+        """Copy the completions of another cache file that are not in this one yet. Returns the number of completions added."""
+        connection = self._connections.get()
+        connection.execute("ATTACH DATABASE ? AS other", [path])
+        try:
+            before = connection.total_changes
+            connection.execute(
+                "INSERT OR IGNORE INTO completions SELECT * FROM other.completions"
+            )
+            return connection.total_changes - before
+        finally:
+            connection.execute("DETACH DATABASE other")
+
+    def size_mb(self) -> float:
+        """Size of the stored prompts and completions."""
+        (size,) = (
+            self._connections.get()
+            .execute("SELECT COALESCE(SUM(size), 0) FROM completions")
+            .fetchone()
+        )
+        return size / 1e6
+
+    def evict(self, max_size_mb: float) -> int:
+        """Drop the least recently used completions until the cache is at most `max_size_mb`. Returns the number of completions dropped."""
+        excess = self.size_mb() - max_size_mb
+        if excess <= 0:
+            return 0
+
+        # the oldest rows whose running total of sizes covers the excess
+        connection = self._connections.get()
+        before = connection.total_changes
+        connection.execute(
+            "DELETE FROM completions WHERE key IN ("
+            "SELECT key FROM (SELECT key, size, "
+            "SUM(size) OVER (ORDER BY last_used, key) AS total FROM completions) "
+            "WHERE total - size < ?)",
+            [excess * 1e6],
+        )
+        return connection.total_changes - before
+
+    def __len__(self):
+        (count,) = (
+            self._connections.get()
+            .execute("SELECT COUNT(*) FROM completions")
+            .fetchone()
+        )
+        return count
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Hits and misses per module."""
+        with self._lock:
+            return {module: dict(counts) for module, counts in self._stats.items()}
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class CachedLM(LMWrapper):
+    """Answers the calls of an LM client from an `LMCache` when it can. Hits and misses are counted under `module`."""
+
+    def __init__(self, lm, cache: LMCache, module: str = None):
+        super().__init__(lm)
+        self.cache = cache
+        self.module = module
+
+    def __call__(self, prompt: str, **kwargs) -> list[str]:
+        # every option that changes the completions, including the model
+        options = {
+            k: v
+            for k, v in (self.lm.kwargs | kwargs).items()
+            if k not in _transport_options
+        }
+        key = self.cache.key(prompt, options)
+
+        completions = self.cache.get(key, self.module)
+        if completions is None:
+            completions = self.lm(prompt, **kwargs)
+            self.cache.put(key, prompt, options, completions)
+        else:
+            self._record(prompt, completions, kwargs)
+        return completions
+
+
+def cache_lms(program, cache: LMCache):
+    """Answer the LM calls of every predictor and LM holder in `program` from `cache`, counting hits per predictor."""
+    for name, predictor in lm_holders(program):
+        if predictor.lm is not None and not isinstance(predictor.lm, CachedLM):
+            predictor.lm = CachedLM(predictor.lm, cache, module=name)
+    return program
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Merge LM caches from several machines into one and evict the least recently used completions."
+    )
+
+    # Add arguments
+    parser.add_argument("--path", type=str, help="Cache file to update.")
+    parser.add_argument(
+        "--merge",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Cache files to merge into --path.",
+    )
+    parser.add_argument(
+        "--max_size_mb",
+        type=float,
+        default=None,
+        help="Evict the least recently used completions until the cache is at most this size (default: no eviction)",
+    )
+    args = parser.parse_args()
+
+    cache = LMCache(args.path)
+    for path in args.merge:
+        print(f"{path}: added {cache.merge(path)} completions.")
+    if args.max_size_mb is not None:
+        print(f"Evicted {cache.evict(args.max_size_mb)} completions.")
+    print(f"{args.path}: {len(cache)} completions, {cache.size_mb():.1f} MB.")
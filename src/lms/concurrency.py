@@ -0,0 +1,119 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable
+
+
+def model_name(lm) -> str:
+    """Name of the model behind an LM client, as it appears in `lm.kwargs` and in saved program states."""
+    return getattr(lm, "kwargs", {}).get("model", "default")
+
+
+def lm_holders(program) -> list[tuple[str, object]]:
+    """Everything in `program` that calls an LM through its `lm` attribute, by name: the predictors, and the holders a program adds through `named_lm_holders`, such as the cascade model of `Rank`."""
+    holders = list(program.named_predictors())
+    if hasattr(program, "named_lm_holders"):
+        holders.extend(program.named_lm_holders())
+    return holders
+
+
+class ModelLimits:
+    """Limits per model, read from a JSON file such as `lm_limits.json`:
+
+        {"default": {"max_concurrency": 8}, "meta-llama/Llama-2-13b-chat-hf": {"max_concurrency": 64}}
+
+    Models are keyed by the `model` of their LM client, so all entries of `lm_config.json` that point to the same model share their limits. Missing values fall back to the "default" entry.
+    """
+
+    def __init__(self, limits: dict = None):
+        self.limits = limits or {}
+
+    def get(self, model: str, key: str, default=None):
+        if key in self.limits.get(model, {}):
+            return self.limits[model][key]
+        return self.limits.get("default", {}).get(key, default)
+
+    def max_concurrency(self, model: str) -> int:
+        return int(self.get(model, "max_concurrency", 8))
+
+    @classmethod
+    def from_json(cls, path: str):
+        with open(path, "r") as fp:
+            return cls(json.load(fp))
+
+
+class LMRunner:
+    """Runs blocking LM calls for coroutines, so one event loop can keep thousands of documents in flight.
+
+    Every model gets its own pool of `max_concurrency` threads: however many coroutines wait for a model, at most that many requests to it are in flight, and the number of OS threads is bounded by the sum of the limits. CPU-bound work such as retrieval runs on a separate, small pool.
+    """
+
+    def __init__(self, limits: ModelLimits = None, cpu_threads: int = 1):
+        self.limits = limits or ModelLimits()
+        self.cpu_threads = cpu_threads
+        self._executors = {}
+        self._cpu_executor = None
+        self._lock = threading.Lock()
+
+    def _executor(self, model: str) -> ThreadPoolExecutor:
+        with self._lock:
+            if model not in self._executors:
+                self._executors[model] = ThreadPoolExecutor(
+                    max_workers=self.limits.max_concurrency(model),
+                    thread_name_prefix=f"lm[{model}]",
+                )
+            return self._executors[model]
+
+    async def run(self, model: str, fn: Callable, *args, **kwargs):
+        """Run a blocking call to `model` within its concurrency limit."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor(model), partial(fn, *args, **kwargs)
+        )
+
+    async def predict(self, predictor, **kwargs):
+        """Call a DSPy predictor within the concurrency limit of its LM."""
+        import dspy
+
+        lm = predictor.lm or dspy.settings.lm
+        return await self.run(model_name(lm), predictor, **kwargs)
+
+    async def run_cpu(self, fn: Callable, *args, **kwargs):
+        """Run CPU-bound work off the event loop."""
+        with self._lock:
+            if self._cpu_executor is None:
+                self._cpu_executor = ThreadPoolExecutor(
+                    max_workers=self.cpu_threads, thread_name_prefix="cpu"
+                )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._cpu_executor, partial(fn, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        with self._lock:
+            for executor in self._executors.values():
+                executor.shutdown()
+            if self._cpu_executor is not None:
+                self._cpu_executor.shutdown()
+            self._executors, self._cpu_executor = {}, None
+
+
+_runner = LMRunner()
+
+
+def get_runner() -> LMRunner:
+    return _runner
+
+
+def configure_runner(limits_path: str = None, cpu_threads: int = 1) -> LMRunner:
+    """Replace the process-wide runner used by the `aforward` methods of the programs."""
+    global _runner
+    _runner.shutdown()
+    _runner = LMRunner(
+        ModelLimits.from_json(limits_path) if limits_path else ModelLimits(),
+        cpu_threads=cpu_threads,
+    )
+    return _runner
@@ -0,0 +1,186 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from .concurrency import ModelLimits, lm_holders, model_name
+from .wrapper import LMWrapper
+
+# default weight of every traffic class when several share the budget of a model,
+# set per model with "traffic_weights" in the LM limits
+default_traffic_weights = {"evaluation": 1.0, "optimization": 1.0}
+
+
+class TokenBucket:
+    """Holds up to `capacity` units and refills at `capacity` units per minute."""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.capacity / 60
+        )
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available. Requests larger than the capacity wait for a full bucket."""
+        self.refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets of one model, shared by all threads.
+
+    Waiting requests are served in weighted fair order over their traffic classes: every class gets a share of the budget proportional to its weight in `traffic_weights` (by default `default_traffic_weights`), and requests within a class are served first come, first served.
+    """
+
+    def __init__(
+        self, rpm: float = None, tpm: float = None, traffic_weights: dict = None
+    ):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.traffic_weights = traffic_weights or default_traffic_weights
+
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._counter = itertools.count()
+        self._virtual_time = 0.0
+        self._class_tags = {}
+
+    def acquire(self, tokens: int, traffic_class: str = "evaluation"):
+        """Block until the request is first in line and both budgets allow it."""
+        with self._condition:
+            # fair queuing: the tag of a request grows with the share its class already had
+            tag = max(self._virtual_time, self._class_tags.get(traffic_class, 0.0))
+            tag += 1.0 / self.traffic_weights.get(traffic_class, 1.0)
+            self._class_tags[traffic_class] = tag
+            entry = (tag, next(self._counter))
+            heapq.heappush(self._waiting, entry)
+
+            try:
+                while True:
+                    if self._waiting[0] == entry:
+                        wait = max(
+                            self.requests.wait_time(1) if self.requests else 0.0,
+                            self.tokens.wait_time(tokens) if self.tokens else 0.0,
+                        )
+                        if wait == 0.0:
+                            break
+                        self._condition.wait(wait)
+                    else:
+                        self._condition.wait()
+            except BaseException:
+                # e.g. KeyboardInterrupt: leave the line, so the next request can go
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            self._virtual_time = tag
+            if self.requests:
+                self.requests.level -= 1
+            if self.tokens:
+                self.tokens.level -= min(tokens, self.tokens.capacity)
+            self._condition.notify_all()
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Rate limits, timeouts, connection errors and server errors are retried, anything else is raised."""
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    if status is None and getattr(error, "response", None) is not None:
+        status = getattr(error.response, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    name = type(error).__name__
+    return any(
+        kind in name
+        for kind in ["RateLimit", "Timeout", "Connection", "ServiceUnavailable"]
+    )
+
+
+class RateLimitedLM(LMWrapper):
+    """Waits for the budget of the model of an LM client before every call and retries failed calls with jittered exponential backoff."""
+
+    def __init__(
+        self,
+        lm,
+        limiter: RateLimiter,
+        traffic_class: str = "evaluation",
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        super().__init__(lm)
+        self.limiter = limiter
+        self.traffic_class = traffic_class
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+
+    def _estimate_tokens(self, prompt: str, kwargs: dict) -> int:
+        # about 4 characters per prompt token, plus the completion tokens the call may use
+        options = self.lm.kwargs | kwargs
+        return len(prompt) // 4 + options.get("max_tokens", 0) * options.get("n", 1)
+
+    def __call__(self, prompt: str, **kwargs) -> list[str]:
+        tokens = self._estimate_tokens(prompt, kwargs)
+        for attempt in itertools.count():
+            self.limiter.acquire(tokens, self.traffic_class)
+            try:
+                return self.lm(prompt, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    raise
+            self.retries += 1
+            # full jitter: spreads out the retries of all threads that failed together
+            time.sleep(
+                random.uniform(
+                    0, min(self.backoff_max, self.backoff_base * 2**attempt)
+                )
+            )
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model: str, limits: ModelLimits) -> RateLimiter:
+    """The limiter of `model`, shared by every LM in the process that calls it."""
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter(
+                rpm=limits.get(model, "rpm"),
+                tpm=limits.get(model, "tpm"),
+                traffic_weights=limits.get(model, "traffic_weights"),
+            )
+        return _limiters[model]
+
+
+def rate_limit_lm(
+    lm, limits: ModelLimits, traffic_class: str = "evaluation"
+) -> RateLimitedLM:
+    model = model_name(lm)
+    return RateLimitedLM(
+        lm,
+        get_limiter(model, limits),
+        traffic_class=traffic_class,
+        max_retries=limits.get(model, "max_retries", 6),
+        backoff_base=limits.get(model, "backoff_base", 1.0),
+        backoff_max=limits.get(model, "backoff_max", 60.0),
+    )
+
+
+def rate_limit_lms(program, limits: ModelLimits, traffic_class: str = "evaluation"):
+    """Put the LM of every predictor and LM holder in `program` behind the budget of its model."""
+    for _, predictor in lm_holders(program):
+        if predictor.lm is not None and not isinstance(predictor.lm, RateLimitedLM):
+            predictor.lm = rate_limit_lm(predictor.lm, limits, traffic_class)
+    return program
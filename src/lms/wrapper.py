@@ -0,0 +1,30 @@
+class LMWrapper:
+    """Stands in for a DSPy LM client and wraps its calls. Subclasses override `__call__`.
+
+    Every other attribute is delegated to the wrapped client `lm`, so the program state is saved as before. Deep copies return the same wrapper, so copies of a program share its batcher, cache or limiter.
+    """
+
+    def __init__(self, lm):
+        self.lm = lm
+
+    def __getattr__(self, name):
+        # only called for attributes this object does not have itself
+        if name == "lm":
+            raise AttributeError(name)
+        return getattr(self.lm, name)
+
+    def __call__(self, prompt: str, **kwargs) -> list[str]:
+        return self.lm(prompt, **kwargs)
+
+    def _record(self, prompt: str, completions: list[str], kwargs: dict):
+        """Add a call the wrapped client did not make itself to its history, as DSPy inspects it."""
+        self.lm.history.append(
+            {
+                "prompt": prompt,
+                "response": {"choices": [{"text": c} for c in completions]},
+                "kwargs": kwargs,
+            }
+        )
+
+    def __deepcopy__(self, memo):
+        return self
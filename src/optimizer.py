@@ -1,6 +1,6 @@
 import dspy
-from dspy.teleprompt import BootstrapFewShotWithRandomSearch
 from src.programs import InferRetrieveRank
+from src.candidate_search import supported_candidate_searches
 from src.evaluators import supported_metrics
 
 
@@ -13,6 +13,7 @@ class LeftToRightOptimizer:
         infer_compile_metric_name: str,
         rank_compile: bool,
         rank_compile_metric_name: str,
+        candidate_search: str = "random",
     ):
         # TODO: add an optimization config
         self.modules_to_lms = modules_to_lms
@@ -30,8 +31,11 @@ class LeftToRightOptimizer:
         self.num_candidate_programs = 10
         self.num_threads = 8
 
+        # how the candidate programs are scored, see `supported_candidate_searches`
+        self.candidate_search = candidate_search
+
     def create_compiler(self, metric):
-        return BootstrapFewShotWithRandomSearch(
+        return supported_candidate_searches[self.candidate_search](
             metric=metric,
             max_bootstrapped_demos=self.max_bootstrapped_demos,
             max_labeled_demos=self.max_labeled_demos,
@@ -111,6 +115,7 @@ class End2EndOptimizer:
         infer_compile_metric_name: str,
         rank_compile: bool,
         rank_compile_metric_name: str,
+        candidate_search: str = "random",
     ):
         # TODO: add an optimization config
         self.modules_to_lms = modules_to_lms
@@ -128,8 +133,11 @@ class End2EndOptimizer:
         self.num_candidate_programs = 10
         self.num_threads = 8
 
+        # how the candidate programs are scored, see `supported_candidate_searches`
+        self.candidate_search = candidate_search
+
     def create_compiler(self, metric):
-        return BootstrapFewShotWithRandomSearch(
+        return supported_candidate_searches[self.candidate_search](
             metric=metric,
             max_bootstrapped_demos=self.max_bootstrapped_demos,
             max_labeled_demos=self.max_labeled_demos,
@@ -252,7 +260,7 @@ class LeftToRightOptimizer2(LeftToRightOptimizer):
         return program
 
     def create_compiler(self, metric):
-        return BootstrapFewShotWithRandomSearch(
+        return supported_candidate_searches[self.candidate_search](
             metric=metric,
             max_bootstrapped_demos=self.max_bootstrapped_demos,
             max_labeled_demos=self.max_labeled_demos,
@@ -0,0 +1,155 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict
+
+import src.batch_metrics as batch_metrics
+
+""" An append-only store of the predictions of evaluation runs. Every example that finishes is written as one JSON line, keyed by the example and the program that predicted it, so an interrupted run can resume and metrics can be computed later without running the program again.
+"""
+
+
+def example_id(example) -> str:
+    """Hash of the input text. The datasets have no ids, and examples are shuffled on load."""
+    return hashlib.sha256(example.text.encode("utf-8")).hexdigest()[:16]
+
+
+def program_hash(program) -> str:
+    """Hash of the program state: its config, demonstrations and LM options."""
+    state = json.dumps(program.dump_state(), sort_keys=True, default=str)
+    return hashlib.sha256(state.encode("utf-8")).hexdigest()[:16]
+
+
+class PredictionStore:
+    """Predictions, per-stage timings and errors of every evaluated example in one JSON lines file.
+
+    Lines are only ever appended, and every line is flushed as soon as it is written, so a crash loses at most the examples that were in flight. Several threads can write at once.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def append(
+        self,
+        program: str,
+        example,
+        prediction: dict = None,
+        error: Exception = None,
+    ):
+        """Write the outcome of one example: the fields of its prediction, or the error it raised."""
+        record = {
+            "program": program,
+            "example": example_id(example),
+            "label": list(example.label),
+            "prediction": prediction,
+            "error": f"{type(error).__name__}: {error}" if error else None,
+        }
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, "a") as fp:
+                fp.write(line + "\n")
+                fp.flush()
+
+    def records(self, program: str = None) -> list[dict]:
+        """All records of `program`, or of every program, in the order they were written. A line cut off by a crash is skipped."""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, "r") as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if program is None or record["program"] == program:
+                    records.append(record)
+        return records
+
+    def completed(self, program: str) -> dict[str, dict]:
+        """The last successful record of every example `program` has finished. Examples that failed are run again."""
+        return {
+            record["example"]: record
+            for record in self.records(program)
+            if record["error"] is None
+        }
+
+    def programs(self) -> dict[str, dict]:
+        """Number of finished and failed examples per program."""
+        completed, failed = defaultdict(set), defaultdict(set)
+        for record in self.records():
+            examples = failed if record["error"] else completed
+            examples[record["program"]].add(record["example"])
+        return {
+            program: {
+                "completed": len(completed[program]),
+                "failed": len(failed[program] - completed[program]),
+            }
+            for program in completed.keys() | failed.keys()
+        }
+
+    def evaluate(self, program: str, max_k: int = 50, n_resamples: int = 1000):
+        """RP@K and Recall@K of the stored predictions of `program`, see `batch_metrics.evaluate`, and the mean seconds per stage."""
+        records = list(self.completed(program).values())
+        results = batch_metrics.evaluate(
+            [r["label"] for r in records],
+            [r["prediction"]["predictions"] for r in records],
+            max_k=max_k,
+            n_resamples=n_resamples,
+        )
+
+        timings = defaultdict(list)
+        for record in records:
+            for stage, seconds in record["prediction"].get("timings", {}).items():
+                timings[stage].append(seconds)
+        results["timings"] = {
+            stage: round(sum(seconds) / len(seconds), 3)
+            for stage, seconds in timings.items()
+        }
+        results["n"] = len(records)
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute metrics from a prediction store, without running the program."
+    )
+
+    # Add arguments
+    parser.add_argument("--path", type=str, help="Path of the prediction store")
+    parser.add_argument(
+        "--program",
+        type=str,
+        default=None,
+        help="Hash of the program to evaluate (default: every program in the store)",
+    )
+    parser.add_argument(
+        "--ks",
+        type=int,
+        nargs="+",
+        default=[1, 5, 10, 20, 50],
+        help="Report RP@K and Recall@K at these K (default: 1 5 10 20 50)",
+    )
+
+    args = parser.parse_args()
+
+    store = PredictionStore(args.path)
+    programs = store.programs()
+    for program in [args.program] if args.program else programs:
+        print(f"Program {program}: {programs[program]}")
+        if not programs[program]["completed"]:
+            continue
+        results = store.evaluate(program, max_k=max(args.ks))
+        for k in args.ks:
+            print(
+                f"  RP@{k}: {results['rp'][k - 1]:.2f} "
+                f"[{results['rp_low'][k - 1]:.2f}, {results['rp_high'][k - 1]:.2f}], "
+                f"Recall@{k}: {results['recall'][k - 1]:.2f} "
+                f"[{results['recall_low'][k - 1]:.2f}, {results['recall_high'][k - 1]:.2f}]"
+            )
+        print(f"  Seconds per stage: {results['timings']}")
@@ -1,8 +1,10 @@
 from .chunking import Chunker
 from .config import IreraConfig
+from .gating import RoutingStats, supported_gates
 from .infer import Infer
 from .rank import Rank
-from .retriever import Retriever
+from .ontology import Ontology, load_ontology
+from .retriever import Retriever, load_retriever
 from .infer_retrieve import InferRetrieve
 from .infer_retrieve_rank import InferRetrieveRank
 from .signatures import supported_signatures
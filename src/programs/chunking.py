@@ -1,28 +1,90 @@
+from bisect import bisect_left
+from functools import lru_cache
+
 from .config import IreraConfig
 
 
+@lru_cache(maxsize=None)
+def _load_tokenizer(tokenizer_name: str):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+@lru_cache(maxsize=256)
+def _token_starts(tokenizer_name: str, text: str) -> tuple[int]:
+    """Character offset at which every token of `text` starts. Cached, so a text is tokenized once."""
+    offsets = _load_tokenizer(tokenizer_name)(
+        text, add_special_tokens=False, return_offsets_mapping=True
+    )["offset_mapping"]
+    return tuple(start for start, _ in offsets)
+
+
 class Chunker:
+    """Splits a text in windows of `chunk_context_window` characters, or tokens if `chunk_tokenizer_name` is set. Windows prefer to end at a newline in their second half.
+
+    Windows are computed as (start, end) offsets into the original text, so the remaining text is never copied.
+    """
+
     def __init__(self, config: IreraConfig):
         self.config = config
         self.chunk_context_window = config.chunk_context_window
         self.chunk_max_windows = config.chunk_max_windows
         self.chunk_window_overlap = config.chunk_window_overlap
+        self.chunk_tokenizer_name = config.chunk_tokenizer_name
 
     def __call__(self, text):
-        snippet_idx = 0
+        for snippet_idx, (start, end) in enumerate(self._spans(text)):
+            yield snippet_idx, text[start:end]
+
+    def spans(self, text: str) -> list[tuple[int, int]]:
+        """(start, end) character offsets of every chunk, with surrounding whitespace excluded."""
+        return list(self._spans(text))
 
-        while snippet_idx < self.chunk_max_windows and text:
-            endpos = int(self.chunk_context_window * (1.0 + self.chunk_window_overlap))
-            snippet, text = text[:endpos], text[endpos:]
+    def _spans(self, text: str):
+        # map positions measured in window units (characters or tokens) to character offsets and back
+        if self.chunk_tokenizer_name:
+            starts = _token_starts(self.chunk_tokenizer_name, text)
 
-            next_newline_pos = snippet.rfind("\n")
+            def to_char(unit):
+                return starts[unit] if unit < len(starts) else len(text)
+
+            def to_unit(char):
+                return bisect_left(starts, char)
+
+        else:
+
+            def to_char(unit):
+                return min(unit, len(text))
+
+            def to_unit(char):
+                return char
+
+        window = int(self.chunk_context_window * (1.0 + self.chunk_window_overlap))
+
+        pos, snippet_idx = 0, 0
+        while snippet_idx < self.chunk_max_windows and pos < len(text):
+            unit = to_unit(pos)
+            endpos = to_char(unit + window)
+
+            # end at the last newline in the window, unless it is in the first half or this is the last window
+            next_newline_pos = text.rfind("\n", pos, endpos)
             if (
-                text
+                endpos < len(text)
                 and next_newline_pos != -1
-                and next_newline_pos >= self.chunk_context_window // 2
+                and next_newline_pos >= to_char(unit + self.chunk_context_window // 2)
             ):
-                text = snippet[next_newline_pos + 1 :] + text
-                snippet = snippet[:next_newline_pos]
+                start, end, pos = pos, next_newline_pos, next_newline_pos + 1
+            else:
+                start, end, pos = pos, endpos, endpos
 
-            yield snippet_idx, snippet.strip()
+            yield self._strip(text, start, end)
             snippet_idx += 1
+
+    @staticmethod
+    def _strip(text: str, start: int, end: int) -> tuple[int, int]:
+        """Shrink a span to exclude leading and trailing whitespace."""
+        snippet = text[start:end]
+        stripped = snippet.lstrip()
+        start += len(snippet) - len(stripped)
+        return start, start + len(stripped.rstrip())
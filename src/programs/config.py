@@ -16,9 +16,22 @@ class IreraConfig:
         self.chunk_context_window = kwargs.pop("chunk_context_window", 3000)
         self.chunk_max_windows = kwargs.pop("chunk_max_windows", 5)
         self.chunk_window_overlap = kwargs.pop("chunk_window_overlap", 0.02)
+        # If set, chunk windows are measured in tokens of this (HuggingFace) tokenizer instead of characters.
+        self.chunk_tokenizer_name = kwargs.pop("chunk_tokenizer_name", None)
+        # None: only use the first chunk. "max" or "mean": fuse the retrieval scores of all chunks.
+        self.chunk_fusion = kwargs.pop("chunk_fusion", None)
 
         # program logic flow
         self.rank_skip = kwargs.pop("rank_skip", False)
+        # Skip Rank for documents whose retrieval ranking is confident: None, "margin", "entropy" or "gap" (see gating.py)
+        self.rank_gate_name = kwargs.pop("rank_gate_name", None)
+        self.rank_gate_threshold = kwargs.pop("rank_gate_threshold", 0.0)
+        self.rank_gate_k = kwargs.pop("rank_gate_k", 10)
+        # Escalate Rank to this model (a name in lm_config.json) when the ranking of its own LM has too few valid options or disagrees with retrieval
+        self.rank_cascade_model_name = kwargs.pop("rank_cascade_model_name", None)
+        self.rank_cascade_min_valid = kwargs.pop("rank_cascade_min_valid", 3)
+        self.rank_cascade_min_agreement = kwargs.pop("rank_cascade_min_agreement", 0.3)
+        self.rank_cascade_k = kwargs.pop("rank_cascade_k", 10)
 
         # ontology
         self.ontology_path = kwargs.pop("ontology_path", None)
@@ -27,8 +40,35 @@ class IreraConfig:
             "retriever_model_name", "sentence-transformers/all-mpnet-base-v2"
         )
 
+        self.retriever_embedding_dtype = kwargs.pop(
+            "retriever_embedding_dtype", "float32"
+        )
+        self.retriever_batch_size = kwargs.pop("retriever_batch_size", 128)
+        self.retriever_encoder_backend = kwargs.pop(
+            "retriever_encoder_backend", "torch"
+        )
+
+        # query embedding cache
+        self.retriever_query_cache_size = kwargs.pop(
+            "retriever_query_cache_size", 100000
+        )
+        self.retriever_query_cache_path = kwargs.pop("retriever_query_cache_path", None)
+
+        # label index
+        self.retriever_index_name = kwargs.pop("retriever_index_name", "exact")
+        self.retriever_index_topk = kwargs.pop("retriever_index_topk", 100)
+        self.retriever_index_ef_search = kwargs.pop("retriever_index_ef_search", 128)
+        self.retriever_index_nprobe = kwargs.pop("retriever_index_nprobe", 16)
+
+        # runtime
+        self.lazy_load = kwargs.pop("lazy_load", False)
+
         # optimizer
         self.optimizer_name = kwargs.pop("optimizer_name", None)
+        # "random" scores every candidate program on the full validation set, "successive-halving" only the promising ones
+        self.optimizer_candidate_search = kwargs.pop(
+            "optimizer_candidate_search", "random"
+        )
 
     def __repr__(self):
         return self.to_dict().__repr__()
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import os
+import hashlib
+import warnings
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import torch
+
+
+def write_atomic(filename: str, write: Callable[[str], None]):
+    """Call `write` with a temporary filename, then move the file into place, so concurrent readers never see a partial file."""
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    write(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+class EmbeddingStore:
+    """On-disk ontology embeddings, keyed by the content of the ontology file and the model that embedded it.
+
+    Embeddings are stored L2-normalized as `.npy` files and memory-mapped read-only, so every process on a machine shares one page-cached copy.
+    Every version also stores its term list, so a new version of an ontology only embeds the terms that were added since the latest version.
+    """
+
+    def __init__(
+        self,
+        ontology_name: str,
+        model_name: str,
+        dtype: str = "float32",
+        embedding_dir: str = os.path.join(".", "data", "embeddings"),
+    ):
+        if dtype not in ("float16", "float32"):
+            raise ValueError(f"Unsupported embedding dtype: {dtype}")
+
+        self.ontology_name = ontology_name
+        self.model_name = model_name
+        self.friendly_model_name = model_name.replace("/", "--")
+        self.dtype = dtype
+        self.embedding_dir = embedding_dir
+
+    def key(self, ontology_path: str) -> str:
+        """Hash of the ontology file contents, the model name and the storage dtype."""
+        digest = hashlib.sha256()
+        with open(ontology_path, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(self.model_name.encode("utf-8"))
+        digest.update(self.dtype.encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def filename(self, key: str) -> str:
+        return os.path.join(
+            self.embedding_dir,
+            f"{self.ontology_name}_embeddings[{self.friendly_model_name}]-{key}.npy",
+        )
+
+    def terms_filename(self, key: str) -> str:
+        return f"{os.path.splitext(self.filename(key))[0]}.terms"
+
+    def latest_filename(self) -> str:
+        """Points to the key of the most recently written version."""
+        return os.path.join(
+            self.embedding_dir,
+            f"{self.ontology_name}_embeddings[{self.friendly_model_name}]-{self.dtype}.latest",
+        )
+
+    def latest(self) -> str:
+        """Key of the most recently written version, None if there is none."""
+        if not os.path.isfile(self.latest_filename()):
+            return None
+        with open(self.latest_filename(), "r") as fp:
+            key = fp.read().strip()
+        return key if os.path.isfile(self.filename(key)) else None
+
+    def load_terms(self, key: str) -> list[str]:
+        with open(self.terms_filename(key), "r") as fp:
+            return [line.strip("\n") for line in fp.readlines()]
+
+    def load(self, key: str) -> torch.Tensor:
+        """Memory-map stored embeddings. The returned tensor is read-only."""
+        import torch
+
+        array = np.load(self.filename(key), mmap_mode="r")
+        with warnings.catch_warnings():
+            # torch warns about wrapping a read-only array, which is exactly what we want
+            warnings.simplefilter("ignore", UserWarning)
+            return torch.from_numpy(array)
+
+    def _write_atomic(self, filename: str, write: Callable):
+        def write_file(tmp_filename: str):
+            with open(tmp_filename, "wb") as fp:
+                write(fp)
+
+        write_atomic(filename, write_file)
+
+    def save(self, key: str, terms: list[str], embeddings: torch.Tensor):
+        """Normalize and write a version. Every file appears atomically and the embeddings file is written last, so concurrent readers never see a partial version."""
+        import torch
+
+        os.makedirs(self.embedding_dir, exist_ok=True)
+        embeddings = torch.nn.functional.normalize(embeddings.float().cpu(), p=2, dim=1)
+
+        self._write_atomic(
+            self.terms_filename(key),
+            lambda fp: fp.write("".join(f"{t}\n" for t in terms).encode("utf-8")),
+        )
+        self._write_atomic(
+            self.filename(key),
+            lambda fp: np.save(fp, embeddings.numpy().astype(self.dtype)),
+        )
+        self._write_atomic(
+            self.latest_filename(), lambda fp: fp.write(key.encode("utf-8"))
+        )
+
+    def update(
+        self, key: str, terms: list[str], encode: Callable[[list[str]], torch.Tensor]
+    ) -> dict[str, int]:
+        """Write version `key` for `terms`, starting from the latest version. Rows of kept terms are copied, only added terms are encoded and removed terms are dropped. Rows follow the order of `terms`."""
+        import torch
+
+        previous_key = self.latest()
+        previous_rows = {}
+        if previous_key is not None:
+            previous_embeddings = self.load(previous_key)
+            for row, term in enumerate(self.load_terms(previous_key)):
+                previous_rows.setdefault(term, row)
+
+        added = list(dict.fromkeys(t for t in terms if t not in previous_rows))
+        added_embeddings = encode(added).float().cpu() if added else None
+        added_rows = {t: i for i, t in enumerate(added)}
+
+        embeddings = torch.empty(
+            len(terms),
+            added_embeddings.shape[1] if added else previous_embeddings.shape[1],
+        )
+        kept = [i for i, t in enumerate(terms) if t in previous_rows]
+        if kept:
+            embeddings[kept] = previous_embeddings[
+                [previous_rows[terms[i]] for i in kept]
+            ].float()
+        new = [i for i, t in enumerate(terms) if t in added_rows]
+        if new:
+            embeddings[new] = added_embeddings[[added_rows[terms[i]] for i in new]]
+
+        self.save(key, terms, embeddings)
+        return {
+            "added": len(added),
+            "removed": len(set(previous_rows).difference(terms)),
+            "kept": len(kept),
+        }
+
+    def load_or_create(
+        self,
+        ontology_path: str,
+        terms: list[str],
+        encode: Callable[[list[str]], torch.Tensor],
+    ) -> tuple[str, torch.Tensor]:
+        """Load the embeddings for the current ontology file. If they are missing, they are derived from the latest version, calling `encode` for new terms only. Returns (filename, embeddings)."""
+        key = self.key(ontology_path)
+        if not os.path.isfile(self.filename(key)):
+            changes = self.update(key, terms, encode)
+            print(
+                f"{self.ontology_name}: embedded {changes['added']} new terms, "
+                f"dropped {changes['removed']}, reused {changes['kept']}."
+            )
+
+        embeddings = self.load(key)
+        if len(embeddings) != len(terms):
+            raise ValueError(
+                f"Stored embeddings for {self.ontology_name} have {len(embeddings)} rows, but the ontology has {len(terms)} terms."
+            )
+        return self.filename(key), embeddings
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from .config import IreraConfig
+    from .retriever import Retriever
+
+    parser = argparse.ArgumentParser(
+        description="Create or update the stored embeddings of an ontology. Only terms added since the latest version are embedded."
+    )
+
+    # Add arguments
+    parser.add_argument("--ontology_path", type=str, help="Path to the ontology file.")
+    parser.add_argument("--ontology_name", type=str, help="Name of the ontology.")
+    parser.add_argument(
+        "--retriever_model_name",
+        type=str,
+        default="sentence-transformers/all-mpnet-base-v2",
+        help="Specify the retriever model name (default: sentence-transformers/all-mpnet-base-v2)",
+    )
+    parser.add_argument(
+        "--retriever_embedding_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16"],
+        help="Specify the storage dtype (default: float32)",
+    )
+    args = parser.parse_args()
+
+    # loading the retriever creates the new version if it does not exist yet
+    Retriever(
+        IreraConfig(
+            infer_signature_name=None,
+            rank_signature_name=None,
+            ontology_path=args.ontology_path,
+            ontology_name=args.ontology_name,
+            retriever_model_name=args.retriever_model_name,
+            retriever_embedding_dtype=args.retriever_embedding_dtype,
+        )
+    )
+    print("Done.")
@@ -0,0 +1,125 @@
+import os
+
+import torch
+from sentence_transformers import SentenceTransformer
+
+from .embedding_store import write_atomic
+
+""" Query encoder backends. Every backend wraps the same SentenceTransformer checkpoint and exposes its `encode` method, so its embeddings can be scored against the ontology embeddings of the reference (full-precision) model. To add a backend, write a loader and add it to `supported_encoder_backends` at the bottom of this file.
+"""
+
+
+def load_reference_encoder(model_name: str) -> SentenceTransformer:
+    model = SentenceTransformer(model_name)
+    model.to("cpu")
+    return model
+
+
+def load_quantized_encoder(model_name: str) -> SentenceTransformer:
+    """Reference model with int8 dynamically quantized linear layers. CPU only."""
+    model = load_reference_encoder(model_name)
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+class _TokenEmbeddings(torch.nn.Module):
+    """Exposes the transformer of a SentenceTransformer with positional inputs, as needed for ONNX export."""
+
+    def __init__(self, transformer: torch.nn.Module, input_names: list[str]):
+        super().__init__()
+        self.transformer = transformer
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.transformer(**dict(zip(self.input_names, inputs)))[0]
+
+
+class OnnxEncoder:
+    """Runs the transformer of a SentenceTransformer as an ONNX graph with onnxruntime. Tokenization, pooling and normalization reuse the SentenceTransformer modules."""
+
+    def __init__(self, model: SentenceTransformer, path: str):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                "The onnx encoder backend requires onnxruntime: `pip install onnxruntime`."
+            )
+
+        self.model = model
+        if not os.path.isfile(path):
+            self._export(path)
+
+        self.session = onnxruntime.InferenceSession(
+            path, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def _export(self, path: str):
+        features = self.model.tokenize(["An example sentence."])
+        input_names = [
+            name
+            for name in ("input_ids", "attention_mask", "token_type_ids")
+            if name in features
+        ]
+        dynamic_axes = {
+            name: {0: "batch", 1: "sequence"}
+            for name in input_names + ["token_embeddings"]
+        }
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(
+            path,
+            lambda tmp_path: torch.onnx.export(
+                _TokenEmbeddings(self.model[0].auto_model, input_names).eval(),
+                tuple(features[name] for name in input_names),
+                tmp_path,
+                input_names=input_names,
+                output_names=["token_embeddings"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            ),
+        )
+
+    def encode(
+        self,
+        sentences: list[str],
+        batch_size: int = 32,
+        convert_to_tensor: bool = True,
+        normalize_embeddings: bool = False,
+        **kwargs,
+    ) -> torch.Tensor:
+        embeddings = []
+        for start in range(0, len(sentences), batch_size):
+            features = self.model.tokenize(sentences[start : start + batch_size])
+            token_embeddings = self.session.run(
+                ["token_embeddings"],
+                {name: features[name].numpy() for name in self.input_names},
+            )[0]
+            features["token_embeddings"] = torch.from_numpy(token_embeddings)
+
+            # pooling and normalization layers of the SentenceTransformer
+            with torch.no_grad():
+                for module in list(self.model)[1:]:
+                    features = module(features)
+            embeddings.append(features["sentence_embedding"])
+
+        embeddings = torch.cat(embeddings)
+        if normalize_embeddings:
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        return embeddings
+
+
+def load_onnx_encoder(model_name: str) -> OnnxEncoder:
+    """Exports the model once to data/encoders and runs it with onnxruntime."""
+    path = os.path.join(
+        ".", "data", "encoders", f"{model_name.replace('/', '--')}.onnx"
+    )
+    return OnnxEncoder(load_reference_encoder(model_name), path)
+
+
+supported_encoder_backends = {
+    "torch": load_reference_encoder,
+    "quantized": load_quantized_encoder,
+    "onnx": load_onnx_encoder,
+}
@@ -0,0 +1,68 @@
+import math
+import threading
+from collections import Counter
+
+""" Confidence of the retrieval ranking of a document, computed from its prior-weighted scores sorted from high to low. Higher means more confident. InferRetrieveRank skips Rank when the confidence is at least `rank_gate_threshold`.
+"""
+
+# scores are cosine similarities reweighed by the prior, this temperature spreads them out before the softmax
+_entropy_temperature = 0.05
+
+
+def margin_confidence(scores: list[float], k: int) -> float:
+    """Score difference between the first and second label."""
+    if len(scores) < 2:
+        return math.inf
+    return scores[0] - scores[1]
+
+
+def entropy_confidence(scores: list[float], k: int) -> float:
+    """One minus the normalized entropy of a softmax over the top `k` scores: 1 when one label dominates, 0 when the top `k` are tied."""
+    scores = scores[:k]
+    if len(scores) < 2:
+        return 1.0
+    exps = [math.exp((s - scores[0]) / _entropy_temperature) for s in scores]
+    total = sum(exps)
+    entropy = -sum(e / total * math.log(e / total) for e in exps if e > 0)
+    return 1.0 - entropy / math.log(len(scores))
+
+
+def gap_confidence(scores: list[float], k: int) -> float:
+    """Score difference between the `k`-th and the next label: how clearly the top `k` separate from the rest."""
+    if len(scores) <= k:
+        return math.inf
+    return scores[k - 1] - scores[k]
+
+
+supported_gates = {
+    "margin": margin_confidence,
+    "entropy": entropy_confidence,
+    "gap": gap_confidence,
+}
+
+
+class RoutingStats:
+    """Thread-safe counts of the route every document took through a program. Deep copies start counting from zero."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, route: str):
+        with self._lock:
+            self.counts[route] += 1
+
+    def fractions(self) -> dict[str, float]:
+        with self._lock:
+            total = sum(self.counts.values())
+            return {route: count / total for route, count in self.counts.items()}
+
+    def reset(self):
+        with self._lock:
+            self.counts = Counter()
+
+    def __repr__(self):
+        return f"RoutingStats({dict(self.counts)})"
+
+    def __deepcopy__(self, memo):
+        return RoutingStats()
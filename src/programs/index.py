@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING
+
+from .config import IreraConfig
+from .embedding_store import write_atomic
+
+if TYPE_CHECKING:
+    import torch
+
+""" Label indexes over the (L2-normalized) ontology embeddings. Every index answers two questions: which K labels are closest to each query (`search`), and what is the best score per label over a set of queries (`max_scores`). To add an index, subclass `LabelIndex` and add it to `supported_indexes` at the bottom of this file.
+"""
+
+
+class LabelIndex:
+    # file extension of the saved index, None if the index is not saved
+    extension = None
+
+    def __init__(self, embeddings: torch.Tensor, config: IreraConfig):
+        self.embeddings = embeddings
+        self.configure(config)
+
+    def configure(self, config: IreraConfig):
+        """Set the search-time parameters. These can be changed without rebuilding the index."""
+        self.topk = config.retriever_index_topk
+
+    def search(
+        self, query_embeddings: torch.Tensor, k: int
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Returns (scores, ids) tensors of shape (n_queries, k). Missing results have id -1."""
+        raise NotImplementedError
+
+    def max_scores(self, query_embeddings: torch.Tensor) -> torch.Tensor:
+        """For every label, the maximum similarity over all queries. Labels that were not retrieved for any query get -inf."""
+        import torch
+
+        scores, ids = self.search(
+            query_embeddings, min(self.topk, len(self.embeddings))
+        )
+        scores, ids = scores.flatten(), ids.flatten()
+        found = ids >= 0
+
+        max_scores = torch.full((len(self.embeddings),), float("-inf"))
+        return max_scores.scatter_reduce_(
+            0, ids[found], scores[found].to(max_scores.dtype), reduce="amax"
+        )
+
+    def save(self, path: str):
+        pass
+
+    @classmethod
+    def load(cls, path: str, embeddings: torch.Tensor, config: IreraConfig):
+        return cls(embeddings, config)
+
+
+class ExactIndex(LabelIndex):
+    """Brute-force search. Scores every label for every query.
+
+    Embeddings are scored in blocks of rows, so memory-mapped and float16 embeddings are only materialized (as float32) one block at a time.
+    """
+
+    block_size = 65536
+
+    def _similarities(self, query_embeddings: torch.Tensor):
+        """Yields (n_queries, block) cosine similarities for consecutive blocks of labels."""
+        query_embeddings = query_embeddings.float()
+        for start in range(0, len(self.embeddings), self.block_size):
+            block = self.embeddings[start : start + self.block_size].float()
+            yield query_embeddings @ block.T
+
+    def search(self, query_embeddings, k):
+        import torch
+
+        similarities = torch.cat(list(self._similarities(query_embeddings)), dim=1)
+        return torch.topk(similarities, k, dim=1)
+
+    def max_scores(self, query_embeddings):
+        import torch
+
+        # (n_queries, n_terms) cosine similarities, reduced over the query axis
+        return torch.cat(
+            [s.max(dim=0).values for s in self._similarities(query_embeddings)]
+        )
+
+
+class HNSWIndex(LabelIndex):
+    """Hierarchical navigable small world graph (hnswlib). Recall and latency grow with `retriever_index_ef_search`."""
+
+    extension = "hnsw"
+
+    def __init__(self, embeddings, config, index=None, M=32, ef_construction=200):
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("The hnsw index requires hnswlib: `pip install hnswlib`.")
+
+        if index is None:
+            index = hnswlib.Index(space="ip", dim=embeddings.shape[1])
+            index.init_index(
+                max_elements=len(embeddings), M=M, ef_construction=ef_construction
+            )
+            index.add_items(
+                embeddings.numpy().astype("float32"), list(range(len(embeddings)))
+            )
+        self.index = index
+
+        super().__init__(embeddings, config)
+
+    def configure(self, config):
+        super().configure(config)
+        self.index.set_ef(max(config.retriever_index_ef_search, self.topk))
+
+    def search(self, query_embeddings, k):
+        import torch
+
+        ids, distances = self.index.knn_query(
+            query_embeddings.numpy().astype("float32"), k=k
+        )
+        # inner product space returns 1 - similarity
+        return 1.0 - torch.from_numpy(distances), torch.from_numpy(ids.astype("int64"))
+
+    def save(self, path):
+        self.index.save_index(path)
+
+    @classmethod
+    def load(cls, path, embeddings, config):
+        import hnswlib
+
+        index = hnswlib.Index(space="ip", dim=embeddings.shape[1])
+        index.load_index(path, max_elements=len(embeddings))
+        return cls(embeddings, config, index=index)
+
+
+class IVFIndex(LabelIndex):
+    """Inverted file index (faiss). Recall and latency grow with `retriever_index_nprobe`."""
+
+    extension = "ivf"
+
+    def __init__(self, embeddings, config, index=None, nlist=None):
+        try:
+            import faiss
+        except ImportError:
+            raise ImportError("The ivf index requires faiss: `pip install faiss-cpu`.")
+
+        if index is None:
+            dim = embeddings.shape[1]
+            # rule of thumb: ~4 * sqrt(n) clusters
+            nlist = nlist or max(1, int(4 * len(embeddings) ** 0.5))
+            index = faiss.IndexIVFFlat(
+                faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT
+            )
+            vectors = embeddings.numpy().astype("float32")
+            index.train(vectors)
+            index.add(vectors)
+        self.index = index
+
+        super().__init__(embeddings, config)
+
+    def configure(self, config):
+        super().configure(config)
+        self.index.nprobe = config.retriever_index_nprobe
+
+    def search(self, query_embeddings, k):
+        import torch
+
+        scores, ids = self.index.search(query_embeddings.numpy().astype("float32"), k)
+        return torch.from_numpy(scores), torch.from_numpy(ids)
+
+    def save(self, path):
+        import faiss
+
+        faiss.write_index(self.index, path)
+
+    @classmethod
+    def load(cls, path, embeddings, config):
+        import faiss
+
+        return cls(embeddings, config, index=faiss.read_index(path))
+
+
+def load_index(
+    config: IreraConfig, embeddings: torch.Tensor, embeddings_filename: str
+) -> LabelIndex:
+    """Load the index configured by `retriever_index_name`. Approximate indexes are built once and saved next to the embeddings file, so they share its content key."""
+    index_class = supported_indexes[config.retriever_index_name]
+    if index_class.extension is None:
+        return index_class(embeddings, config)
+
+    index_filename = (
+        f"{os.path.splitext(embeddings_filename)[0]}.{index_class.extension}"
+    )
+    if os.path.isfile(index_filename):
+        return index_class.load(index_filename, embeddings, config)
+
+    # written atomically, so concurrent workers never load a partial index
+    index = index_class(embeddings, config)
+    write_atomic(index_filename, index.save)
+    return index
+
+
+supported_indexes = {
+    "exact": ExactIndex,
+    "hnsw": HNSWIndex,
+    "ivf": IVFIndex,
+}
@@ -1,5 +1,6 @@
 import dspy
 
+from src.lms import get_runner
 from src.utils import extract_labels_from_strings
 from .config import IreraConfig
 from .signatures import supported_signatures
@@ -14,9 +15,16 @@ class Infer(dspy.Module):
         )
 
     def forward(self, text: str) -> dspy.Prediction:
+        return self._parse(self.cot(text=text))
+
+    async def aforward(self, text: str) -> dspy.Prediction:
+        """`forward` without blocking the event loop, within the concurrency limit of the LM."""
+        return self._parse(await get_runner().predict(self.cot, text=text))
+
+    def _parse(self, prediction: dspy.Prediction) -> dspy.Prediction:
         parsed_outputs = set()
 
-        output = self.cot(text=text).completions.output
+        output = prediction.completions.output
         parsed_outputs.update(
             extract_labels_from_strings(output, do_lower=False, strip_punct=False)
         )
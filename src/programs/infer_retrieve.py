@@ -1,14 +1,21 @@
-import math
-import json
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
 import dspy
+from src.lms import get_runner
 from .config import IreraConfig
-from .retriever import Retriever
+from .retriever import load_retriever
 from .infer import Infer
 
+if TYPE_CHECKING:
+    import torch
+
 
 class InferRetrieve(dspy.Module):
-    """Infer-Retrieve. Sets the Retriever, initializes the prior."""
+    """Infer-Retrieve. Sets the Retriever and the prior strength."""
 
     def __init__(
         self,
@@ -21,41 +28,133 @@ class InferRetrieve(dspy.Module):
         # set LM predictor
         self.infer = Infer(config)
 
-        # set retriever
-        self.retriever = Retriever(config)
+        # set retriever, shared by every program in this process with the same retriever config
+        self.retriever = load_retriever(config)
 
-        # set prior and prior strength
-        self.prior = self._set_prior(config.prior_path)
+        # set prior strength, the prior itself is part of the shared ontology
         self.prior_A = config.prior_A
 
+        # only the top K labels are returned, InferRetrieveRank never uses more
+        self.topk = config.rank_topk
+
     def forward(self, text: str) -> dspy.Prediction:
         # Use the LM to predict label queries per chunk
         preds = self.infer(text).predictions
 
+        # Nothing to retrieve with
+        if not preds:
+            return dspy.Prediction(predictions=[], scores=[], exact_matches=0)
+
         # Execute the queries against the label index and get the maximal score per label
         scores = self.retriever.retrieve(preds)
 
+        return self._rank_labels(preds, scores)
+
+    async def aforward(self, text: str) -> dspy.Prediction:
+        """`forward` on an event loop. The LM call is awaited, retrieval runs on the CPU executor of the runner."""
+        return await self.aforward_chunks([text])
+
+    async def aforward_chunks(
+        self, chunks: list[str], fusion: str = "max"
+    ) -> dspy.Prediction:
+        """Infer for all chunks of one document concurrently, then retrieve and fuse their scores off the event loop."""
+        preds = [
+            p.predictions
+            for p in await asyncio.gather(*(self.infer.aforward(c) for c in chunks))
+        ]
+        predictions = await get_runner().run_cpu(
+            self.retrieve_documents, [preds], fusion
+        )
+        return predictions[0]
+
+    def forward_batch(
+        self, texts: list[str], num_threads: int = 1
+    ) -> list[dspy.Prediction]:
+        """Run Infer for every text, then retrieve for all of them in one batch."""
+        return self.forward_chunks([[text] for text in texts], num_threads=num_threads)
+
+    def forward_chunks(
+        self, documents: list[list[str]], num_threads: int = 1, fusion: str = "max"
+    ) -> list[dspy.Prediction]:
+        """Run Infer for every chunk of every document concurrently, retrieve for all chunks in one batch and fuse the chunk scores per document (`max` or `mean`)."""
+        chunks = [chunk for document in documents for chunk in document]
+        preds = self._infer_all(chunks, num_threads)
+
+        documents_preds, start = [], 0
+        for document in documents:
+            documents_preds.append(preds[start : start + len(document)])
+            start += len(document)
+        return self.retrieve_documents(documents_preds, fusion)
+
+    def retrieve_documents(
+        self, documents_preds: list[list[set[str]]], fusion: str = "max"
+    ) -> list[dspy.Prediction]:
+        """Retrieve for the inferred queries of every chunk of every document in one batch and fuse the chunk scores per document."""
+        preds = [p for document_preds in documents_preds for p in document_preds]
+
+        # Execute all non-empty query sets against the label index at once
+        non_empty = [p for p in preds if p]
+        scores = iter(self.retriever.retrieve_batch(non_empty) if non_empty else [])
+        scores = [next(scores) if p else None for p in preds]
+
+        predictions, start = [], 0
+        for document_preds in documents_preds:
+            end = start + len(document_preds)
+            document_scores = [s for s in scores[start:end] if s is not None]
+            start = end
+
+            if not document_scores:
+                predictions.append(
+                    dspy.Prediction(predictions=[], scores=[], exact_matches=0)
+                )
+                continue
+
+            queries = set().union(*document_preds)
+            predictions.append(
+                self._rank_labels(queries, self._fuse(document_scores, fusion))
+            )
+        return predictions
+
+    def _infer_all(self, texts: list[str], num_threads: int) -> list[set[str]]:
+        """Infer for every text on a thread pool. The first text runs on the calling thread, so its call is traced as usual during compilation."""
+        with ThreadPoolExecutor(max_workers=max(1, num_threads - 1)) as executor:
+            futures = [executor.submit(self.infer, t) for t in texts[1:]]
+            first = [self.infer(texts[0]).predictions] if texts else []
+            return first + [f.result().predictions for f in futures]
+
+    def _fuse(self, scores: list[torch.Tensor], fusion: str) -> torch.Tensor:
+        import torch
+
+        if len(scores) == 1:
+            return scores[0]
+        if fusion == "max":
+            return torch.stack(scores).max(dim=0).values
+        if fusion == "mean":
+            return torch.stack(scores).mean(dim=0)
+        raise ValueError(f"Unsupported chunk fusion: {fusion}")
+
+    def _rank_labels(self, queries: set[str], scores: torch.Tensor) -> dspy.Prediction:
+        import torch
+
         # Reweigh scores with prior statistics
         scores = self._update_scores_with_prior(scores)
 
-        # Return the labels sorted
-        labels = sorted(scores, key=lambda k: scores[k], reverse=True)
+        # Select the top K labels, sorted. Labels that were not retrieved (approximate indexes) are dropped.
+        scores, ids = torch.topk(scores, min(self.topk, len(scores)))
+        found = torch.isfinite(scores)
+        scores, ids = scores[found], ids[found]
+        labels = [self.retriever.ontology_terms[i] for i in ids.tolist()]
+
+        # Number of queries that were verbatim ontology terms and skipped the encoder
+        exact_matches = sum(
+            i is not None for i in self.retriever.match_exact(list(queries))
+        )
 
         return dspy.Prediction(
             predictions=labels,
+            scores=scores.tolist(),
+            exact_matches=exact_matches,
         )
 
-    def _set_prior(self, prior_path):
-        """Loads the priors given a path and makes sure every term has a prior value (default value is 0)."""
-        prior = json.load(open(prior_path, "r"))
-        # Add 0 for every ontology term not in the file
-        terms = self.retriever.ontology_terms
-        terms_not_in_prior = set(terms).difference(set(prior.keys()))
-        return prior | {t: 0.0 for t in terms_not_in_prior}
-
-    def _update_scores_with_prior(self, scores: dict[str, float]) -> dict[str, float]:
-        scores = {
-            label: score * math.log(self.prior_A * self.prior[label] + math.e)
-            for label, score in scores.items()
-        }
-        return scores
+    def _update_scores_with_prior(self, scores: torch.Tensor) -> torch.Tensor:
+        return scores * self.retriever.ontology.prior_weights(self.prior_A)
@@ -1,10 +1,16 @@
+import asyncio
 import dspy
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
 from .infer_retrieve import InferRetrieve
 from .config import IreraConfig
 from .rank import Rank
 from .chunking import Chunker
+from .gating import RoutingStats, supported_gates
+from .pipeline import Pipeline, Stage
 
 
 class InferRetrieveRank(dspy.Module):
@@ -27,41 +33,261 @@ class InferRetrieveRank(dspy.Module):
         # Set Rank
         self.rank = Rank(config)
 
+        # Chunking hyperparameter
+        self.chunk_fusion = config.chunk_fusion
+
         # Ranking hyperparameter
         self.rank_skip = config.rank_skip
         self.rank_topk = config.rank_topk
 
+        # Gate Rank per document on the confidence of the retrieval ranking
+        self.rank_gate_name = config.rank_gate_name
+        self.rank_gate_threshold = config.rank_gate_threshold
+        self.rank_gate_k = config.rank_gate_k
+        self.rank_routes = RoutingStats()
+
+        # Per-stage utilization of the last `forward_pipelined` run
+        self.pipeline_stats = {}
+
     def forward(self, text: str) -> dspy.Prediction:
-        # Take the first chunk
-        _, text = next(self.chunker(text))
+        start = time.perf_counter()
+        chunks = self._chunks(text)
 
-        # Get ranking from InferRetrieve
-        prediction = self.infer_retrieve(text)
-        labels = prediction.predictions
+        # Get ranking from InferRetrieve, fusing the scores of all chunks
+        if len(chunks) == 1:
+            prediction = self.infer_retrieve(chunks[0])
+        else:
+            prediction = self.infer_retrieve.forward_chunks(
+                [chunks], num_threads=len(chunks), fusion=self.chunk_fusion
+            )[0]
+        timings = {"infer_retrieve": time.perf_counter() - start}
 
-        # Get candidates
-        options = labels[: self.rank_topk]
+        # Rank sees the first chunk
+        return self._rerank(chunks[0], prediction, timings)
 
-        # Rerank
-        if not self.rank_skip:
-            predictions = self.rank(text, options).predictions
+    def forward_batch(
+        self,
+        texts: list[str],
+        num_threads: int = 1,
+        return_exceptions: bool = False,
+        on_result: Callable[[int, object], None] = None,
+    ) -> list[dspy.Prediction]:
+        """Run the program on many texts. Retrieval for all texts is batched, LM calls run on `num_threads` threads. With `return_exceptions`, the error of a text that fails is returned in place of its prediction, and a failed retrieval fails every text of the batch. `on_result` is called with the index and the prediction, or error, of every text as soon as it is done."""
+        start = time.perf_counter()
+        try:
+            documents = [self._chunks(text) for text in texts]
 
-            # Only keep options that are valid
-            selected_options = [o for o in predictions if o in options]
+            # Get rankings from InferRetrieve
+            predictions = self.infer_retrieve.forward_chunks(
+                documents, num_threads=num_threads, fusion=self.chunk_fusion
+            )
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            if on_result is not None:
+                for index in range(len(texts)):
+                    on_result(index, e)
+            return [e] * len(texts)
+        # the batch is timed as a whole, every document gets its share
+        elapsed = (time.perf_counter() - start) / max(len(texts), 1)
 
-            # print(f"Rank returned {len(selected_options)} valid options.")
+        def rerank(index, chunks, prediction):
+            try:
+                result = self._rerank(
+                    chunks[0], prediction, {"infer_retrieve": elapsed}
+                )
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                result = e
+            if on_result is not None:
+                on_result(index, result)
+            return result
 
-            # Supplement options
-            selected_options = selected_options + [
-                o for o in options if o not in selected_options
-            ]
-        else:
-            selected_options = options
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            return list(executor.map(rerank, range(len(texts)), documents, predictions))
+
+    def forward_pipelined(
+        self,
+        texts: list[str],
+        infer_workers: int = 8,
+        retrieve_workers: int = 1,
+        rank_workers: int = 8,
+        queue_size: int = 32,
+        retrieve_batch_size: int = 32,
+        return_exceptions: bool = False,
+        on_result: Callable[[int, object], None] = None,
+    ) -> list[dspy.Prediction]:
+        """Run the program on a stream of texts as a pipeline of three stages, with a bounded queue between them: Infer (chunking and the Infer LM), retrieve (encoding, search and the prior, batched over the documents that are waiting) and Rank (the gate and the Rank LM). While one document waits on the Rank LM, the next ones are retrieved and inferred. With `return_exceptions`, the error of a text that fails is returned in place of its prediction, and `on_result` is called with the index and the prediction, or error, of every text as soon as it leaves the Rank stage. Per-stage utilization of the run is kept in `pipeline_stats`."""
+        pipeline = Pipeline(
+            [
+                Stage("infer", self._infer_stage, workers=infer_workers),
+                Stage(
+                    "retrieve",
+                    self._retrieve_stage,
+                    workers=retrieve_workers,
+                    batch_size=retrieve_batch_size,
+                ),
+                Stage("rank", self._rank_stage, workers=rank_workers),
+            ],
+            queue_size=queue_size,
+        )
+        predictions = pipeline.run(
+            texts, return_exceptions=return_exceptions, on_result=on_result
+        )
+        self.pipeline_stats = pipeline.stats
+        return predictions
 
+    def _infer_stage(self, texts: list[str]) -> list[tuple]:
+        documents = []
+        for text in texts:
+            start = time.perf_counter()
+            chunks = self._chunks(text)
+            preds = [self.infer_retrieve.infer(c).predictions for c in chunks]
+            documents.append((chunks, preds, {"infer": time.perf_counter() - start}))
+        return documents
+
+    def _retrieve_stage(self, documents: list[tuple]) -> list[tuple]:
+        start = time.perf_counter()
+        predictions = self.infer_retrieve.retrieve_documents(
+            [preds for _, preds, _ in documents], fusion=self.chunk_fusion
+        )
+        # the batch is timed as a whole, every document gets its share
+        elapsed = (time.perf_counter() - start) / len(documents)
+
+        # Rank sees the first chunk
+        return [
+            (chunks[0], p, timings | {"retrieve": elapsed})
+            for (chunks, _, timings), p in zip(documents, predictions)
+        ]
+
+    def _rank_stage(self, documents: list[tuple]) -> list[dspy.Prediction]:
+        return [
+            self._rerank(text, prediction, timings)
+            for text, prediction, timings in documents
+        ]
+
+    async def aforward(self, text: str) -> dspy.Prediction:
+        """`forward` on an event loop. LM calls are awaited within the per-model concurrency limits of `src.lms.get_runner()`, so many documents can be in flight at once."""
+        start = time.perf_counter()
+        chunks = self._chunks(text)
+
+        # Get ranking from InferRetrieve, fusing the scores of all chunks
+        prediction = await self.infer_retrieve.aforward_chunks(
+            chunks, fusion=self.chunk_fusion
+        )
+        # wall time, including the time spent waiting on other documents
+        timings = {"infer_retrieve": time.perf_counter() - start}
+
+        # Rank sees the first chunk
+        if self._skip_rank(prediction):
+            return self._ranked_output(prediction, timings)
+        start = time.perf_counter()
+        ranking = await self.rank.aforward(
+            chunks[0], prediction.predictions[: self.rank_topk]
+        )
+        return self._ranked_output(
+            prediction, timings, ranking, time.perf_counter() - start
+        )
+
+    async def aforward_batch(
+        self, texts: list[str], return_exceptions: bool = False
+    ) -> list[dspy.Prediction]:
+        """Run `aforward` for all texts concurrently. With `return_exceptions`, the error of a text that fails is returned in place of its prediction."""
+        return await asyncio.gather(
+            *(self.aforward(text) for text in texts),
+            return_exceptions=return_exceptions,
+        )
+
+    def _chunks(self, text: str) -> list[str]:
+        # Take the first chunk, or up to `chunk_max_windows` chunks if their scores are fused
+        if self.chunk_fusion is None:
+            return [next(self.chunker(text))[1]]
+        return [chunk for _, chunk in self.chunker(text)]
+
+    def _rerank(
+        self, text: str, prediction: dspy.Prediction, timings: dict = None
+    ) -> dspy.Prediction:
+        # Rerank, unless the retrieval ranking is confident enough
+        if self._skip_rank(prediction):
+            return self._ranked_output(prediction, timings)
+
+        start = time.perf_counter()
+        ranking = self.rank(text, prediction.predictions[: self.rank_topk])
+        return self._ranked_output(
+            prediction, timings, ranking, time.perf_counter() - start
+        )
+
+    def _ranked_output(
+        self,
+        prediction: dspy.Prediction,
+        timings: dict = None,
+        ranking: dspy.Prediction = None,
+        rank_seconds: float = 0.0,
+    ) -> dspy.Prediction:
+        """The output for the retrieval `prediction` and its `ranking` by Rank, None if Rank was skipped. Shared by the sync and async paths."""
+        # Get candidates
+        options = prediction.predictions[: self.rank_topk]
+        timings = timings or {}
+
+        if ranking is None:
+            return self._output(options, prediction, "skipped", timings)
+        return self._output(
+            self._supplement(ranking.predictions, options),
+            prediction,
+            self._route(ranking),
+            timings | {"rank": rank_seconds},
+        )
+
+    def _skip_rank(self, prediction: dspy.Prediction) -> bool:
+        if self.rank_skip:
+            return True
+        if self.rank_gate_name is None:
+            return False
+        confidence = supported_gates[self.rank_gate_name](
+            prediction.scores, self.rank_gate_k
+        )
+        return confidence >= self.rank_gate_threshold
+
+    def _route(self, ranking: dspy.Prediction) -> str:
+        # "ranked" if the Rank LM served the document, "escalated:<reason>" if the cascade model did
+        if ranking.escalated is None:
+            return "ranked"
+        return f"escalated:{ranking.escalated}"
+
+    def _output(
+        self,
+        selected_options: list[str],
+        prediction: dspy.Prediction,
+        route: str,
+        timings: dict,
+    ) -> dspy.Prediction:
+        # Keep the retrieval ranking and its scores, so gates can be calibrated on the outputs
+        self.rank_routes.add(route)
         return dspy.Prediction(
             predictions=selected_options,
+            retrieved=prediction.predictions[: self.rank_topk],
+            scores=prediction.scores[: self.rank_topk],
+            ranked=route != "skipped",
+            route=route,
+            # queries that were verbatim ontology terms and skipped the encoder
+            exact_matches=prediction.exact_matches,
+            # seconds per stage
+            timings=timings,
         )
 
+    def _supplement(self, predictions: list[str], options: list[str]) -> list[str]:
+        # Only keep options that are valid
+        selected_options = [o for o in predictions if o in options]
+
+        # print(f"Rank returned {len(selected_options)} valid options.")
+
+        # Supplement options
+        return selected_options + [o for o in options if o not in selected_options]
+
+    def named_lm_holders(self):
+        return [(f"rank.{name}", h) for name, h in self.rank.named_lm_holders()]
+
     def dump_state(self):
         """Dump the state. Uses the DSPy dump_state but also adds the config file."""
         return super().dump_state() | {"config": self.config.to_dict()}
@@ -70,9 +296,9 @@ class InferRetrieveRank(dspy.Module):
         super().load_state(state)
 
     @classmethod
-    def from_state(cls, state: dict):
-        # get the config
-        config = IreraConfig.from_dict(state["config"])
+    def from_state(cls, state: dict, **config_overrides):
+        # get the config, optionally overriding runtime options such as `lazy_load`
+        config = IreraConfig.from_dict(state["config"] | config_overrides)
         # create a new program
         program = cls(config)
         # load the state
@@ -80,9 +306,9 @@ class InferRetrieveRank(dspy.Module):
         return program
 
     @classmethod
-    def load(cls, path: str):
+    def load(cls, path: str, **config_overrides):
         state = json.load(open(path, "r"))
-        return cls.from_state(state)
+        return cls.from_state(state, **config_overrides)
 
     def save(self, path: str):
         state = self.dump_state()
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import json
+import math
+import threading
+from typing import TYPE_CHECKING, Callable
+
+from src.utils import normalize
+from .config import IreraConfig
+from .embedding_store import EmbeddingStore
+
+if TYPE_CHECKING:
+    import torch
+
+
+class Ontology:
+    """The terms of an ontology with their embeddings and prior, in compact arrays aligned with `terms`.
+
+    An ontology is immutable: load it with `load_ontology`, which returns one shared instance per process. Deep copies return the same instance.
+    """
+
+    def __init__(
+        self, config: IreraConfig, encode: Callable[[list[str]], torch.Tensor]
+    ):
+        self.name = config.ontology_name
+        self.path = config.ontology_path
+        self.prior_path = config.prior_path
+
+        # terms and their index
+        self.terms = self._load_terms()
+        self.term_to_index = {}
+        for i, term in enumerate(self.terms):
+            self.term_to_index.setdefault(term, i)
+        # normalized term --> index, for queries that are verbatim ontology terms
+        self.normalized_term_to_index = self.exact_term_index(self.terms)
+
+        # Embeddings are stored L2-normalized, so cosine similarity is a plain matrix multiply.
+        self.embedding_store = EmbeddingStore(
+            self.name,
+            config.retriever_model_name,
+            dtype=config.retriever_embedding_dtype,
+        )
+        self.embeddings_filename, self.embeddings = self.embedding_store.load_or_create(
+            self.path, self.terms, encode
+        )
+
+        # prior probability of every term, 0 for terms without a prior
+        self.prior = self._load_prior()
+        self._prior_weights = None
+
+    def __len__(self):
+        return len(self.terms)
+
+    @staticmethod
+    def normalize_term(term: str) -> str:
+        # Only surrounding whitespace is stripped: case and punctuation change the embedding, e.g. "C++", "C#" and "C".
+        return normalize(term, do_lower=False, strip_punct=False)
+
+    @classmethod
+    def exact_term_index(cls, terms: list[str]) -> dict[str, int]:
+        """Normalized term --> index of the term. Keys that several different terms normalize to are dropped, so a query never reuses the embedding of another term."""
+        index, ambiguous = {}, set()
+        for i, term in enumerate(terms):
+            key = cls.normalize_term(term)
+            if key in index and terms[index[key]] != term:
+                ambiguous.add(key)
+            index.setdefault(key, i)
+        return {key: i for key, i in index.items() if key not in ambiguous}
+
+    def _load_terms(self) -> list[str]:
+        with open(self.path, "r") as fp:
+            return [line.strip("\n") for line in fp.readlines()]
+
+    def _load_prior(self) -> torch.Tensor:
+        import torch
+
+        prior = torch.zeros(len(self.terms))
+        if self.prior_path is None:
+            return prior
+        with open(self.prior_path, "r") as fp:
+            for term, value in json.load(fp).items():
+                if term in self.term_to_index:
+                    prior[self.term_to_index[term]] = value
+        return prior
+
+    def prior_weights(self, prior_A: float) -> torch.Tensor:
+        """log(prior_A * prior + e) for every term. Only recomputed when `prior_A` changes."""
+        import torch
+
+        # read and replace the (prior_A, weights) pair as a whole, so concurrent callers never mix them
+        cached = self._prior_weights
+        if cached is None or cached[0] != prior_A:
+            cached = (prior_A, torch.log(prior_A * self.prior + math.e))
+            self._prior_weights = cached
+        return cached[1]
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+_ontologies = {}
+_ontologies_lock = threading.Lock()
+
+
+def load_ontology(
+    config: IreraConfig, encode: Callable[[list[str]], torch.Tensor]
+) -> Ontology:
+    """Load an ontology once per process. `encode` embeds terms that have no stored embeddings yet."""
+    key = (
+        config.ontology_name,
+        config.ontology_path,
+        config.prior_path,
+        config.retriever_model_name,
+        config.retriever_embedding_dtype,
+    )
+    with _ontologies_lock:
+        if key not in _ontologies:
+            _ontologies[key] = Ontology(config, encode)
+        return _ontologies[key]
@@ -0,0 +1,159 @@
+import queue
+import threading
+import time
+from typing import Callable
+
+""" A pipelined executor: items flow through stages that each have their own workers, with a bounded queue between every two stages. While one item waits on a slow stage, the next items are already processed by the earlier stages.
+"""
+
+
+class Stage:
+    """One step of a pipeline. `fn` maps a list of up to `batch_size` items to a list of results. Every worker takes the items that are waiting, up to `batch_size`, so a stage only batches when it falls behind."""
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[list], list],
+        workers: int = 1,
+        batch_size: int = 1,
+    ):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+
+
+class _Failed:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_done = object()
+
+
+class Pipeline:
+    """Runs items through `stages` in order. Every queue between stages holds at most `queue_size` items, so a fast stage blocks instead of running ahead of a slow one (backpressure). Results are returned in input order. An item that fails in a stage skips the later stages, and its error is raised, or returned in its place with `return_exceptions`. `on_result` is called with the index and the result, or error, of every item as soon as it leaves the last stage."""
+
+    def __init__(self, stages: list[Stage], queue_size: int = 32):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {}
+
+    def run(
+        self,
+        items: list,
+        return_exceptions: bool = False,
+        on_result: Callable[[int, object], None] = None,
+    ) -> list:
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        queues.append(queue.Queue())
+        busy = {stage.name: 0.0 for stage in self.stages}
+        processed = {stage.name: 0 for stage in self.stages}
+        remaining = [stage.workers for stage in self.stages]
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def feed():
+            for index, item in enumerate(items):
+                if stop.is_set():
+                    break
+                queues[0].put((index, item))
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_done)
+
+        def work(i: int, stage: Stage):
+            inbox, outbox = queues[i], queues[i + 1]
+            while True:
+                batch = [inbox.get()]
+                while batch[-1] is not _done and len(batch) < stage.batch_size:
+                    try:
+                        batch.append(inbox.get_nowait())
+                    except queue.Empty:
+                        break
+                finished = batch[-1] is _done
+                batch = [entry for entry in batch if entry is not _done]
+
+                # failed items pass through untouched, so their error reaches the caller
+                todo = [
+                    (index, item)
+                    for index, item in batch
+                    if not isinstance(item, _Failed)
+                ]
+                if todo:
+                    start = time.perf_counter()
+                    try:
+                        results = stage.fn([item for _, item in todo])
+                    except Exception as e:
+                        results = [_Failed(e)] * len(todo)
+                    with lock:
+                        busy[stage.name] += time.perf_counter() - start
+                        processed[stage.name] += len(todo)
+                    results = dict(zip([index for index, _ in todo], results))
+                else:
+                    results = {}
+
+                for index, item in batch:
+                    outbox.put((index, results.get(index, item)))
+
+                if finished:
+                    # the last worker of a stage tells every worker of the next stage to stop
+                    with lock:
+                        remaining[i] -= 1
+                        last = remaining[i] == 0
+                    if last:
+                        next_workers = (
+                            self.stages[i + 1].workers
+                            if i + 1 < len(self.stages)
+                            else 1
+                        )
+                        for _ in range(next_workers):
+                            outbox.put(_done)
+                    return
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=work, args=(i, stage), daemon=True)
+                for _ in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+
+        results = [None] * len(items)
+        callback_error = None
+        while (entry := queues[-1].get()) is not _done:
+            index, result = entry
+            results[index] = result
+            if on_result is not None and callback_error is None:
+                try:
+                    on_result(
+                        index, result.error if isinstance(result, _Failed) else result
+                    )
+                except Exception as e:
+                    # stop feeding and let the items in flight drain, so no worker is left blocked
+                    callback_error = e
+                    stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # utilization: the fraction of the time the workers of a stage were busy
+        self.stats = {
+            stage.name: {
+                "items": processed[stage.name],
+                "busy_seconds": round(busy[stage.name], 2),
+                "utilization": round(busy[stage.name] / (elapsed * stage.workers), 3),
+            }
+            for stage in self.stages
+        }
+        self.stats["elapsed_seconds"] = round(elapsed, 2)
+
+        if callback_error is not None:
+            raise callback_error
+        for index, result in enumerate(results):
+            if isinstance(result, _Failed):
+                if not return_exceptions:
+                    raise result.error
+                results[index] = result.error
+        return results
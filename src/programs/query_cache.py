@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+from src.utils import SQLiteConnections
+
+if TYPE_CHECKING:
+    import torch
+
+
+class QueryEmbeddingCache:
+    """Two-tier cache of query embeddings, keyed by (model name, normalized query).
+
+    The in-memory tier is an LRU bounded by `max_size` entries. The optional on-disk tier is a SQLite file that several processes can read and write at the same time.
+    The cache is shared, never copied, when a program is deep-copied.
+    """
+
+    def __init__(self, model_name: str, max_size: int = 100000, path: str = None):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.path = path
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connections = SQLiteConnections(path) if path else None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.path:
+            self._connections.get().execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT, query TEXT, embedding BLOB, PRIMARY KEY (model, query))"
+            )
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        # Only whitespace is normalized: case and punctuation change the embedding of cased models.
+        return " ".join(query.split())
+
+    def _get_memory(self, queries: list[str]) -> dict[str, torch.Tensor]:
+        found = {}
+        with self._lock:
+            for query in queries:
+                if query in self._memory:
+                    self._memory.move_to_end(query)
+                    found[query] = self._memory[query]
+        return found
+
+    def _put_memory(self, embeddings: dict[str, torch.Tensor]):
+        with self._lock:
+            for query, embedding in embeddings.items():
+                self._memory[query] = embedding
+                self._memory.move_to_end(query)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _get_disk(self, queries: list[str]) -> dict[str, torch.Tensor]:
+        import torch
+
+        if not self.path:
+            return {}
+        found = {}
+        # stay below SQLite's limit on the number of bound variables
+        for start in range(0, len(queries), 500):
+            batch = queries[start : start + 500]
+            placeholders = ", ".join("?" * len(batch))
+            rows = self._connections.get().execute(
+                f"SELECT query, embedding FROM query_embeddings WHERE model = ? AND query IN ({placeholders})",
+                [self.model_name, *batch],
+            )
+            for query, embedding in rows:
+                found[query] = torch.from_numpy(
+                    np.frombuffer(embedding, dtype=np.float32).copy()
+                )
+        return found
+
+    def _put_disk(self, embeddings: dict[str, torch.Tensor]):
+        if not self.path or not embeddings:
+            return
+        self._connections.get().executemany(
+            "INSERT OR IGNORE INTO query_embeddings VALUES (?, ?, ?)",
+            [
+                (self.model_name, query, embedding.float().numpy().tobytes())
+                for query, embedding in embeddings.items()
+            ],
+        )
+
+    def encode(
+        self, queries: list[str], encode: Callable[[list[str]], torch.Tensor]
+    ) -> torch.Tensor:
+        """Returns the embeddings of `queries`, in order. Only queries missing from both tiers are passed to `encode`."""
+        import torch
+
+        queries = [self.normalize_query(q) for q in queries]
+        unique = list(dict.fromkeys(queries))
+
+        found = self._get_memory(unique)
+        missing = [q for q in unique if q not in found]
+
+        from_disk = self._get_disk(missing)
+        missing = [q for q in missing if q not in from_disk]
+
+        encoded = {}
+        if missing:
+            # clone the rows, so evicting one entry frees its memory
+            encoded = {
+                q: e.clone() for q, e in zip(missing, encode(missing).float().cpu())
+            }
+            self._put_disk(encoded)
+
+        self._put_memory(from_disk | encoded)
+        found = found | from_disk | encoded
+
+        with self._lock:
+            self.hits += len(unique) - len(from_disk) - len(missing)
+            self.disk_hits += len(from_disk)
+            self.misses += len(missing)
+
+        return torch.stack([found[q] for q in queries])
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+    def __deepcopy__(self, memo):
+        return self
@@ -1,23 +1,97 @@
+import copy
+from types import SimpleNamespace
+
 import dspy
+from src.lms import get_runner
 from src.utils import extract_labels_from_strings
 from .config import IreraConfig
 from .signatures import supported_signatures
 
 
 class Rank(dspy.Module):
+    """Rank the options for a text. With `rank_cascade_model_name` set, the LM of `cot` ranks first and the text is escalated to the cascade model when that ranking returns too few valid options or disagrees with the retrieval ordering of the options."""
+
     def __init__(self, config: IreraConfig):
         super().__init__()
 
         self.config = config
         self.cot = dspy.ChainOfThought(supported_signatures[config.rank_signature_name])
 
+        # cascade hyperparameters
+        self.cascade_model_name = config.rank_cascade_model_name
+        self.cascade_min_valid = config.rank_cascade_min_valid
+        self.cascade_min_agreement = config.rank_cascade_min_agreement
+        self.cascade_k = config.rank_cascade_k
+        # holds the cascade LM in `lm`, like a predictor, so LM wrappers can replace it
+        self._cascade = SimpleNamespace(lm=None)
+
     def forward(self, text: str, options: list[str]) -> dspy.Predict:
+        prediction = self._parse(self.cot(text=text, options=options))
+
+        reason = self._escalation_reason(prediction.predictions, options)
+        if reason is None:
+            return prediction
+        return self._parse(
+            self._cascade_cot()(text=text, options=options), escalated=reason
+        )
+
+    async def aforward(self, text: str, options: list[str]) -> dspy.Prediction:
+        """`forward` without blocking the event loop, within the concurrency limit of the LM."""
+        prediction = self._parse(
+            await get_runner().predict(self.cot, text=text, options=options)
+        )
+
+        reason = self._escalation_reason(prediction.predictions, options)
+        if reason is None:
+            return prediction
+        return self._parse(
+            await get_runner().predict(self._cascade_cot(), text=text, options=options),
+            escalated=reason,
+        )
+
+    def _escalation_reason(self, predictions: list[str], options: list[str]) -> str:
+        """Why a ranking should be escalated to the cascade model, None if it should not."""
+        if self.cascade_model_name is None:
+            return None
+
+        valid = list(dict.fromkeys(p for p in predictions if p in options))
+        if len(valid) < min(self.cascade_min_valid, len(options)):
+            return "too_few_valid"
+
+        # fraction of the top K of the ranking that retrieval also ranked in its top K
+        k = min(self.cascade_k, len(valid))
+        if k == 0:
+            # nothing to compare, e.g. no options or `cascade_min_valid` 0
+            return None
+        agreement = len(set(valid[:k]).intersection(options[: self.cascade_k])) / k
+        if agreement < self.cascade_min_agreement:
+            return "disagreement"
+        return None
+
+    def named_lm_holders(self) -> list[tuple[str, SimpleNamespace]]:
+        """LM holders besides the predictors: the cascade model, so rate limits, batching and the cache also cover escalations."""
+        if self.cascade_model_name is None:
+            return []
+        if self._cascade.lm is None:
+            self._cascade.lm = dspy.Models.get_lm(self.cascade_model_name)
+        return [("cascade", self._cascade)]
+
+    def _cascade_cot(self) -> dspy.ChainOfThought:
+        # the same predictor and demos on the cascade model, not an attribute so it is never saved or compiled
+        self.named_lm_holders()
+        cot = copy.copy(self.cot)
+        cot.lm = self._cascade.lm
+        return cot
+
+    def _parse(
+        self, prediction: dspy.Prediction, escalated: str = None
+    ) -> dspy.Prediction:
         parsed_outputs = []
 
-        output = self.cot(text=text, options=options).completions.output
+        output = prediction.completions.output
 
         parsed_outputs = extract_labels_from_strings(
             output, do_lower=False, strip_punct=False, split_colon=True
         )
 
-        return dspy.Prediction(predictions=parsed_outputs)
+        return dspy.Prediction(predictions=parsed_outputs, escalated=escalated)
@@ -1,14 +1,36 @@
-import os
-import torch
-import sentence_transformers
-from sentence_transformers import SentenceTransformer
-from functools import lru_cache
-from collections import defaultdict
+from __future__ import annotations
+
+import json
+import threading
+from typing import TYPE_CHECKING
 
 from .config import IreraConfig
+from .index import load_index
+from .ontology import load_ontology
+from .query_cache import QueryEmbeddingCache
+
+# torch is imported where it is used, so importing the program stays cheap
+if TYPE_CHECKING:
+    import torch
+
+# In lazy mode, these attributes are created on first access by the given method.
+_lazy_attributes = {
+    "model": "_load_model",
+    "query_cache": "_load_model",
+    "ontology": "_load_ontology",
+    "ontology_terms": "_load_ontology",
+    "ontology_embeddings": "_load_ontology",
+    "index": "_load_ontology",
+}
+_lazy_lock = threading.RLock()
 
 
 class Retriever:
+    """Embeds queries and scores them against every ontology term.
+
+    The model, the query cache and the index are immutable after loading and shared: load a retriever with `load_retriever`, which returns one instance per process and retriever config. Deep copies return the same instance, so the programs an optimizer copies never duplicate the model weights or the embeddings.
+    """
+
     def __init__(self, config: IreraConfig):
         self.config = config
 
@@ -18,79 +40,161 @@ class Retriever:
         self.ontology_name = config.ontology_name
         self.ontology_term_path = config.ontology_path
 
+        self.encoder_backend = config.retriever_encoder_backend
+
+        # In lazy mode, the model weights and the ontology are loaded on first use.
+        if not config.lazy_load:
+            self.load()
+
+    def __getattr__(self, name):
+        # Only called for attributes that do not exist (yet), i.e. lazily loaded ones.
+        if name not in _lazy_attributes:
+            raise AttributeError(name)
+        with _lazy_lock:
+            if name not in self.__dict__:
+                getattr(self, _lazy_attributes[name])()
+        return self.__dict__[name]
+
+    def load(self):
+        """Load the model weights and the ontology now, unless they are loaded already."""
+        self.model
+        self.index
+
+    def _load_model(self):
+        # sentence_transformers is imported here, so importing the program stays cheap
+        from .encoders import supported_encoder_backends
+
         # Initialize Retriever
-        self.model = SentenceTransformer(self.retriever_model_name)
-        self.model.to("cpu")
-
-        # Initialize Ontology
-        self.ontology_terms = self._load_terms()
-        self.ontology_embeddings = self._load_embeddings()
-
-    def _load_terms(self) -> list[str]:
-        with open(self.ontology_term_path, "r") as fp:
-            return [line.strip("\n") for line in fp.readlines()]
-
-    def _load_embeddings(self) -> torch.Tensor:
-        """Load or create embeddings for all query terms."""
-        embedding_dir = os.path.join('.', 'data', 'embeddings')
-        if not os.path.exists(embedding_dir):
-            os.makedirs(embedding_dir)
-        ontology_embeddings_filename = os.path.join(embedding_dir,f"{self.ontology_name}_embeddings[{self.friendly_model_name}].pt")
-
-        # If the file exists, load. Else, create embeddings.
-        if os.path.isfile(ontology_embeddings_filename):
-            with open(ontology_embeddings_filename, "rb") as f:
-                ontology_embeddings = torch.load(f, map_location=torch.device("cpu"))
+        self.model = supported_encoder_backends[self.encoder_backend](
+            self.retriever_model_name
+        )
+
+        # Initialize query embedding cache
+        self.query_cache = QueryEmbeddingCache(
+            f"{self.retriever_model_name}[{self.encoder_backend}]",
+            max_size=self.config.retriever_query_cache_size,
+            path=self.config.retriever_query_cache_path,
+        )
+
+    def _load_ontology(self):
+        # Initialize Ontology, shared by every program in this process
+        self.ontology = load_ontology(self.config, self._encode_terms)
+        self.ontology_terms = self.ontology.terms
+        self.ontology_embeddings = self.ontology.embeddings
+
+        # Initialize label index
+        self.index = load_index(
+            self.config, self.ontology_embeddings, self.ontology.embeddings_filename
+        )
+
+    def _encode_terms(self, terms: list[str]) -> torch.Tensor:
+        # The ontology is always embedded by the reference model, whatever the query encoder backend.
+        import torch
+        from .encoders import load_reference_encoder
+
+        if self.encoder_backend == "torch":
+            model = self.model
         else:
-            self.model.to(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
-            ontology_embeddings = self.model.encode(
-                self.ontology_terms, convert_to_tensor=True, show_progress_bar=True
-            )
-            with open(ontology_embeddings_filename, "wb") as f:
-                torch.save(ontology_embeddings, f)
-            self.model.to(torch.device("cpu"))
+            model = load_reference_encoder(self.retriever_model_name)
+
+        model.to(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+        ontology_embeddings = model.encode(
+            terms, convert_to_tensor=True, show_progress_bar=True
+        )
+        model.to(torch.device("cpu"))
         return ontology_embeddings
 
-    @lru_cache(maxsize=100000)
-    def retrieve_individual(self, query: str, K: int = 3) -> list[tuple[float, str]]:
-        """Finds K closest matches based on semantic embedding similarity. Returns a list of (similarity_score, query) tuples."""
-        query_embeddings = self.model.encode(query, convert_to_tensor=True)
-        query_result = sentence_transformers.util.semantic_search(
-            query_embeddings, self.ontology_embeddings, query_chunk_size=64, top_k=K
-        )[0]
+    def _encode_queries(self, queries: list[str]) -> torch.Tensor:
+        """Normalized query embeddings. Only queries that are not cached are passed through the model."""
+        return self.query_cache.encode(
+            queries,
+            lambda qs: self.model.encode(
+                qs,
+                batch_size=self.config.retriever_batch_size,
+                convert_to_tensor=True,
+                normalize_embeddings=True,
+            ),
+        )
 
-        # get (score, term) tuples
-        matches = []
-        for result in query_result:
-            score = result["score"]
-            term = self.ontology_terms[result["corpus_id"]]
-            matches.append((score, term))
+    def match_exact(self, queries: list[str]) -> list[int]:
+        """Ontology index of every query that is a verbatim ontology term after normalization, None otherwise."""
+        term_index = self.ontology.normalized_term_to_index
+        return [term_index.get(self.ontology.normalize_term(q)) for q in queries]
 
-        return sorted(matches, reverse=True)
+    def _embed_queries(self, queries: list[str]) -> torch.Tensor:
+        """Normalized query embeddings. Queries that are ontology terms reuse the term embedding, only the others go to the encoder."""
+        import torch
 
-    def retrieve(self, queries: set[str]) -> dict[str, float]:
-        """For every label in the ontology, get the maximum similarity over all queries. Returns a query --> max_score map."""
+        term_ids = self.match_exact(queries)
+        embeddings = torch.empty(len(queries), self.ontology_embeddings.shape[1])
 
-        queries = list(queries)
+        exact = [i for i, t in enumerate(term_ids) if t is not None]
+        if exact:
+            embeddings[exact] = self.ontology_embeddings[
+                [term_ids[i] for i in exact]
+            ].float()
 
-        # get similarities for each query
-        query_embeddings = self.model.encode(queries, convert_to_tensor=True)
-        query_results = sentence_transformers.util.semantic_search(
-            query_embeddings,
-            self.ontology_embeddings,
-            query_chunk_size=64,
-            top_k=len(self.ontology_embeddings),
-        )
+        other = [i for i, t in enumerate(term_ids) if t is None]
+        if other:
+            embeddings[other] = self._encode_queries([queries[i] for i in other])
+
+        return embeddings
+
+    def retrieve_individual(self, query: str, K: int = 3) -> list[tuple[float, str]]:
+        """Finds K closest matches based on semantic embedding similarity. Returns a list of (similarity_score, query) tuples."""
+        query_embeddings = self._embed_queries([query])
+        scores, ids = self.index.search(query_embeddings, K)
 
-        # reformat results to be a query --> [score] map
-        query_results_reformat = defaultdict(list)
-        for query, query_result in zip(queries, query_results):
-            for r in query_result:
-                query = self.ontology_terms[r["corpus_id"]]
-                query_score = r["score"]
-                query_results_reformat[query].append(query_score)
+        # get (score, term) tuples
+        matches = []
+        for score, corpus_id in zip(scores[0].tolist(), ids[0].tolist()):
+            if corpus_id >= 0:
+                matches.append((score, self.ontology_terms[corpus_id]))
 
-        # for every query get the maximum score
-        query_to_score = {k: max(v) for k, v in query_results_reformat.items()}
+        return sorted(matches, reverse=True)
 
-        return query_to_score
+    def retrieve(self, queries: set[str]) -> torch.Tensor:
+        """For every label in the ontology, get the maximum similarity over all queries. Returns a score tensor aligned with `self.ontology_terms`."""
+        return self.retrieve_batch([queries])[0]
+
+    def retrieve_batch(self, query_sets: list[set[str]]) -> list[torch.Tensor]:
+        """Retrieve for many documents at once. Queries are deduplicated across documents and encoded together. Returns one score tensor per query set."""
+        query_sets = [list(queries) for queries in query_sets]
+
+        # get normalized embeddings for every unique query
+        unique_queries = list(dict.fromkeys(q for queries in query_sets for q in queries))
+        query_embeddings = self._embed_queries(unique_queries)
+        query_ids = {q: i for i, q in enumerate(unique_queries)}
+
+        return [
+            self.index.max_scores(query_embeddings[[query_ids[q] for q in queries]])
+            for queries in query_sets
+        ]
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+_retrievers = {}
+_retrievers_lock = threading.Lock()
+
+
+def load_retriever(config: IreraConfig) -> Retriever:
+    """Load a retriever once per process and retriever config: the options of the model, the ontology and the index."""
+    key = json.dumps(
+        {
+            name: value
+            for name, value in config.to_dict().items()
+            if name.startswith(("retriever_", "ontology_")) or name == "prior_path"
+        },
+        sort_keys=True,
+    )
+    with _retrievers_lock:
+        if key not in _retrievers:
+            _retrievers[key] = Retriever(config)
+        retriever = _retrievers[key]
+
+    # a retriever first loaded lazily is loaded now, if this program does not load lazily
+    if not config.lazy_load:
+        retriever.load()
+    return retriever
@@ -1,4 +1,6 @@
 import re
+import sqlite3
+import threading
 
 
 def normalize(
@@ -59,3 +61,20 @@ def extract_labels_from_strings(
     return extract_labels_from_string(
         labels, do_lower=do_lower, strip_punct=strip_punct, split_colon=split_colon
     )
+
+
+class SQLiteConnections:
+    """Connections to one SQLite file in WAL mode, so several threads and processes can read and write it at once."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads, so every thread opens its own.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
@@ -0,0 +1,34 @@
+import warnings
+
+import numpy as np
+
+import src.batch_metrics as batch_metrics
+from src.metrics import recall_at_k, rp_at_k
+
+
+def test_matches_scalar_metrics():
+    gold = [["a", "b"], ["c"], ["a"]]
+    predicted = [["b", "x", "a"], ["x", "y"], ["a"]]
+    results = batch_metrics.evaluate(gold, predicted, max_k=3, n_resamples=10)
+    for k in range(1, 4):
+        rp = np.mean([rp_at_k(g, p, k) for g, p in zip(gold, predicted)])
+        recall = np.mean([recall_at_k(g, p, k) for g, p in zip(gold, predicted)])
+        assert np.isclose(results["rp"][k - 1], 100 * rp)
+        assert np.isclose(results["recall"][k - 1], 100 * recall)
+
+
+def test_new_labels_do_not_collide_with_sparse_ids():
+    # term_to_index skips the ids of repeated terms, so its ids are not contiguous
+    label_to_id = {"a": 0, "b": 2}
+    gold_ids, predicted_ids = batch_metrics.encode(
+        [["new"]], [["b"]], max_k=1, label_to_id=label_to_id
+    )
+    assert not batch_metrics.hits(gold_ids, predicted_ids).any()
+
+
+def test_empty_input():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        results = batch_metrics.evaluate([], [], max_k=5, n_resamples=10)
+    for name in ["rp", "rp_low", "rp_high", "recall", "recall_low", "recall_high"]:
+        assert np.array_equal(results[name], np.zeros(5))
@@ -0,0 +1,18 @@
+from src.programs.ontology import Ontology
+
+
+def test_exact_term_index_keeps_case_and_punctuation():
+    index = Ontology.exact_term_index(["C++", "C#", "C", ".NET", "net"])
+    assert index == {"C++": 0, "C#": 1, "C": 2, ".NET": 3, "net": 4}
+
+
+def test_exact_term_index_drops_collisions():
+    # different terms that normalize to the same key must not reuse each other's embedding
+    index = Ontology.exact_term_index(["C", " C", "Python"])
+    assert "C" not in index
+    assert index["Python"] == 2
+
+
+def test_exact_term_index_keeps_repeated_terms():
+    index = Ontology.exact_term_index(["Java", "Go", "Java"])
+    assert index == {"Java": 0, "Go": 1}
@@ -0,0 +1,25 @@
+from src.programs.config import IreraConfig
+from src.programs.rank import Rank
+
+
+def make_rank(**kwargs) -> Rank:
+    config = IreraConfig(
+        infer_signature_name="infer_esco",
+        rank_signature_name="rank_esco",
+        rank_cascade_model_name="cascade",
+        **kwargs,
+    )
+    return Rank(config)
+
+
+def test_no_options_is_not_escalated():
+    assert make_rank()._escalation_reason([], []) is None
+
+
+def test_min_valid_zero_without_valid_predictions_is_not_escalated():
+    rank = make_rank(rank_cascade_min_valid=0)
+    assert rank._escalation_reason(["unknown"], ["a", "b"]) is None
+
+
+def test_too_few_valid_is_escalated():
+    assert make_rank()._escalation_reason(["a"], ["a", "b", "c"]) == "too_few_valid"